@@ -58,7 +58,7 @@
 ;;       $ sudo port install gst-plugins-ugly
 ;;       $ sudo port install py27-gst-python
 ;; 
-;;   2. Getting the source files (`gaplay.el` and `gaplay.py`)
+;;   2. Getting the source files (`gaplay.el`, `gaplay.py` and `gaplay_common.py`)
 ;;     If you have installed git:
 ;;	 $ git clone git://github.com/te223/gaplay-el.git
 ;;     else:
@@ -66,10 +66,11 @@
 ;;       * click `ZIP` icon to download source code as zip archive.
 ;;       * unpack it.
 ;; 
-;;   3. Copy `gaplay.el` and `gaplay.py` to somewhere in your emacs `load-path`.  
+;;   3. Copy `gaplay.el`, `gaplay.py` and `gaplay_common.py` to somewhere
+;;      in your emacs `load-path`.
 ;;      (e.g /usr/local/share/emacs/site-lisp, ~/elisp )
 ;;      for example:
-;;       $ sudo cp -p gaplay.el gaplay.py /usr/local/share/emacs/site-lisp/
+;;       $ sudo cp -p gaplay.el gaplay.py gaplay_common.py /usr/local/share/emacs/site-lisp/
 ;;
 ;;   4. Add this into your .emacs file (or ~/.emacs.d/init.el)
 ;;       ;;
@@ -169,7 +170,17 @@ FMT and ARGS are same as `(message FMT ARG ...)'"
  (expand-file-name "gaplay.py" (file-name-directory load-file-name))
  "*gst player program path")
 
-(gaplay-defvar gaplay-player-script-options '())
+(gaplay-defvar gaplay-player-script-options '()
+  "*Command line options of gaplay-player-script
+e.g. '(\"--sink=alsasink\" \"--sink-device=hw:0\" \"--sink-profile=low-power\")
+     '(\"--engine=gst1\") ; GStreamer 1.x engine (gaplay1.py)
+     '(\"--normalize\") ; volume normalization by ReplayGain
+     '(\"--retention=7:2000\") ; keep recordings 7 days and 2000MB at most
+     '(\"--postproc=flac,trim\") ; trim and encode finished recordings")
+
+(gaplay-defvar gaplay-capture-script-options '()
+  "*Command line options of the capture process (`gaplay.py --captures')
+e.g. '(\"--retention=7:2000\" \"--postproc=flac,trim\")")
 
 (gaplay-defvar gaplay-buffer-name "*gaplay*")
 ;; timeline
@@ -182,6 +193,9 @@ FMT and ARGS are same as `(message FMT ARG ...)'"
 
 (gaplay-defvar gaplay-seeking-seconds 5)
 
+(gaplay-defvar gaplay-prefetch-tracks 2
+  "*Number of upcoming playlist entries to prefetch or resolve, 0: disable")
+
 (gaplay-defvar gaplay-shrink-window-height 4)
 
 (gaplay-defvar gaplay-read-url-history nil)
@@ -389,6 +403,24 @@ e.g.
     (and (eq major-mode 'gaplay-mode)
 	 (local-variable-p 'gaplay-anchor-list))))
 
+(defvar gaplay-time-subscribed t) ;; buffer local, see gaplay-mode
+
+(defun gaplay-update-subscription ()
+  "Unsubscribe time events of the player process while its buffer is hidden"
+  (mapc #'(lambda (buf)
+	    (when (gaplay-buffer-p buf)
+	      (with-current-buffer buf
+		(let ((visible (if (get-buffer-window buf 'visible) t nil)))
+		  (when (and (processp gaplay-process)
+			     (eq (process-status gaplay-process) 'run)
+			     (not (eq visible gaplay-time-subscribed)))
+		    (setq gaplay-time-subscribed visible)
+		    (process-send-string gaplay-process
+					 (if visible "subscribe time\n"
+					   "unsubscribe time\n")))))))
+	(buffer-list)))
+(add-hook 'window-configuration-change-hook 'gaplay-update-subscription)
+
 (defun gaplay-which-command (command)
   (catch 'gaplay-break
     (mapc
@@ -431,6 +463,8 @@ turning on gaplay-mode runs the hook `gaplay-mode-hook'."
 
     ;; initialize buffer-local-variable 
     (set (make-local-variable 'gaplay-process) nil) ;; player process
+    ;; player process sends `T' responses
+    (set (make-local-variable 'gaplay-time-subscribed) t)
     (set (make-local-variable 'gaplay-anchor-list) nil)
     (set (make-local-variable 'gaplay-source) nil)
     (set (make-local-variable 'gaplay-boot-messages) nil)
@@ -486,6 +520,7 @@ turning on gaplay-mode runs the hook `gaplay-mode-hook'."
   (let ((process-connection-type t) ;; use pty
 	)
     (setq gaplay-boot-messages nil)
+    (setq gaplay-time-subscribed t)
     (setq gaplay-process
 	  (apply #'start-process
 		 `("gaplay.py" ,(current-buffer)
@@ -583,6 +618,60 @@ turning on gaplay-mode runs the hook `gaplay-mode-hook'."
 		       (delete-process proc)) old-process)
       )))
 
+
+;; Background captures run in a process of their own, which is not
+;; restarted by gaplay-load-source like gaplay-process.
+(defvar gaplay-capture-process nil)
+
+(defun gaplay-capture-connect ()
+  "Start capture process unless running. Return the process."
+  (unless (and (processp gaplay-capture-process)
+	       (eq (process-status gaplay-capture-process) 'run))
+    (let ((process-connection-type t)) ;; use pty, line buffered
+      (setq gaplay-capture-process
+	    (apply #'start-process
+		   `("gaplay-capture" nil
+		     ,gaplay-python-command ,gaplay-player-script "--captures"
+		     . ,gaplay-capture-script-options)))
+      (set-process-query-on-exit-flag gaplay-capture-process nil)
+      (set-process-filter
+       gaplay-capture-process
+       (lexical-let ((pending-data ""))
+	 #'(lambda (proc data)
+	     (let ((dlst (split-string (concat pending-data data) "\r?\n")))
+	       (setq pending-data (car (last dlst)))
+	       (dolist (rsp (butlast dlst))
+		 (gaplay-log "capture: %s" rsp)
+		 (if (string-match "^->\\([A-Z]+\\)[ \t]*" rsp)
+		     (message "gaplay %s: %s" (downcase (match-string 1 rsp))
+			      (substring rsp (match-end 0)))))))))))
+  gaplay-capture-process)
+
+(defun gaplay-capture-send (command)
+  (process-send-string (gaplay-capture-connect) (concat command "\n")))
+
+(defun gaplay-capture-start (name url)
+  "Record URL in background into ~/.gaplay/NAME-YYYY-MM-DD.wav"
+  (interactive "sCapture name: \nsURL: ")
+  (gaplay-capture-send (format "capture start %s %s" name url)))
+
+(defun gaplay-capture-stop (name)
+  "Stop background capture NAME"
+  (interactive "sStop capture: ")
+  (gaplay-capture-send (format "capture stop %s" name)))
+
+(defun gaplay-capture-status ()
+  (interactive)
+  (gaplay-capture-send "capture status"))
+
+(defun gaplay-capture-quit ()
+  "Stop all captures and the capture process"
+  (interactive)
+  (when (processp gaplay-capture-process)
+    (if (eq (process-status gaplay-capture-process) 'run)
+	(process-send-string gaplay-capture-process "quit\n"))
+    (setq gaplay-capture-process nil)))
+
 (defun gaplay-get-buffer ()
   "Get gaplay buffer.
   if current-buffer is gaplay-plylst-buffer:
@@ -673,9 +762,15 @@ turning on gaplay-mode runs the hook `gaplay-mode-hook'."
 	  (setq gaplay-player-tags nil)
 	  (setq gaplay-player-list-response nil)
 	  (setq gaplay-source src)
-	  (gaplay-disconnect)
-	  (gaplay-connect)
-	  (setq gaplay-player-state 'CONNECTING)
+	  (if (and (processp gaplay-process)
+		   (eq (process-status gaplay-process) 'run)
+		   (memq gaplay-player-state '(PLAYING PAUSED IDLE)))
+	      ;; reuse running player, it switches tracks through READY.
+	      ;; not while LOADING, load-http may block it in get_playlist
+	      (gaplay-send-load)
+	    (gaplay-disconnect)
+	    (gaplay-connect)
+	    (setq gaplay-player-state 'CONNECTING))
 	  (gaplay-render-current)
 	  (if (not (gaplay-url-file-p (gaplay-source-path)))
 	      (let ((kdef (or (car (gaplay-key-descriptions 'gaplay-stop/interrupt))
@@ -917,11 +1012,23 @@ In a Lisp program, PATH must not be nil"
       (save-excursion (gaplay-render-playmode))
       (message "Play mode: %s" (gaplay-playmode-string "normal")))))
 
+(defvar gaplay-scrub-timer nil)
+
 (defun gaplay-seek (seconds)
-  (if (and (gaplay-loaded-p) (not (eq gaplay-player-state 'IDLE)))
-      (process-send-string gaplay-process (format "skip %d\n" seconds))
+  ;; Scrub by key-unit seeks while the key is repeated,
+  ;; then settle with one accurate seek.
+  (when (and (gaplay-loaded-p) (not (eq gaplay-player-state 'IDLE)))
+    (process-send-string gaplay-process (format "scrub %+d\n" seconds))
+    (if (timerp gaplay-scrub-timer) (cancel-timer gaplay-scrub-timer))
+    (setq gaplay-scrub-timer
+	  (run-at-time 0.3 nil 'gaplay-scrub-end gaplay-process))
     ))
 
+(defun gaplay-scrub-end (proc)
+  (setq gaplay-scrub-timer nil)
+  (if (eq (process-status proc) 'run)
+      (process-send-string proc "scrub-end\n")))
+
 (defun gaplay-seek-forward ()
   (interactive)
   (when (or (gaplay-buffer-p) (gaplay-plylst-buffer-p))
@@ -1057,24 +1164,47 @@ TIMESTRING: mm:ss or hh:mm:ss"
   (setq gaplay-player-state nil)
   (gaplay-render-state))
 
+(defun gaplay-send-load ()
+  "Send load command of gaplay-source to gaplay-process"
+  (let ((path (gaplay-source-path)))
+    (process-send-string
+     gaplay-process
+     (format (cond ((gaplay-source-shoutcast-p) 
+		    "gain %f\nload-shoutcast 1 %s\n")
+		   ((gaplay-url-http-p path) "gain %f\nload-http %s\n")
+		   (t "gain %f\nload %s\n"))
+	     (gaplay-gain/mute) path))
+    (setq gaplay-player-state 'LOADING)))
+
 (defun gaplay-ready-response (arg)
   (if (and (eq gaplay-player-state 'CONNECTING) gaplay-source)
-      (let ((path (gaplay-source-path)))
-	(process-send-string
-	 gaplay-process
-	 (format (cond ((gaplay-source-shoutcast-p) 
-			"gain %f\nload-shoutcast 1 %s\n")
-		       ((gaplay-url-http-p path) "gain %f\nload-http %s\n")
-		       (t "gain %f\nload %s\n"))
-		 (gaplay-gain/mute) path))
-	(setq gaplay-player-state 'LOADING))
+      (gaplay-send-load)
     (setq gaplay-player-state 'IDLE))
   (gaplay-render-state))
 
+(defun gaplay-send-upcoming ()
+  "Send next playlist entries to prefetch (local file) or resolve (http)"
+  (when (and (> gaplay-prefetch-tracks 0) (processp gaplay-process)
+	     (bufferp gaplay-plylst-buffer) (not (gaplay-shuffle-mode-p)))
+    (let ((entries
+	   (with-current-buffer gaplay-plylst-buffer
+	     (let ((n gaplay-prefetch-tracks) (pnt nil) (result nil))
+	       (while (and (> n 0) (setq pnt (gaplay-next-plylst-pos pnt)))
+		 (setq result (cons (gaplay-line-content pnt) result))
+		 (setq n (1- n)))
+	       (nreverse result)))))
+      (dolist (entry entries)
+	(cond ((not (gaplay-url-p entry))
+	       (process-send-string gaplay-process
+				    (format "upcoming %s\n" entry)))
+	      ((gaplay-url-http-p entry)
+	       (process-send-string gaplay-process
+				    (format "resolve %s\n" entry))))))))
+
 (defun gaplay-eos-response (arg)
   (let ((current-state gaplay-player-state))
-    (gaplay-disconnect)
-    (setq gaplay-player-state nil)
+    ;; keep the process for the next entry, disconnect at the end
+    (setq gaplay-player-state 'IDLE)
     (let ((pos (car gaplay-player-timeinfo))
 	  (dur (cdr gaplay-player-timeinfo)))
       (when (and (> dur 0) (> pos 0) (> (/ (float pos) (float dur)) 0.9))
@@ -1084,8 +1214,10 @@ TIMESTRING: mm:ss or hh:mm:ss"
     (gaplay-log "End of stream - %s" arg)
     (gaplay-render-message "End of the music")
     (gaplay-render-state)
-    (if (not (memq gaplay-player-state '(CONNECTING LOADING)))
-	(gaplay-load-next))
+    (unless (gaplay-load-next)
+      (gaplay-disconnect)
+      (setq gaplay-player-state nil)
+      (gaplay-render-state))
     ))
 
 (defun gaplay-error-response (arg &optional keep-connect)
@@ -1140,6 +1272,7 @@ TIMESTRING: mm:ss or hh:mm:ss"
 	(gaplay-set-order 1 (marker-position gaplay-play-marker))))
     )
   (gaplay-log "Loaded %S" gaplay-player-url)
+  (gaplay-send-upcoming)
   (gaplay-render-message
    (format "Load %s" 
 	   (decode-coding-string
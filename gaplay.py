@@ -16,24 +16,61 @@ _copyright = "Copyright (c) 2012 Tetsu Takaishi.  All rights reserved."
 _license = "BSD"
 
 import sys, time, re, os, threading, signal
-import datetime, os.path, urllib, urllib2, random
+import os.path, wave, bisect, getopt
+from gaplay_common import _isdebug, _puts, RECONNECT_STABLE, \
+    POSTPROC_TAGS, SINK_DEFAULT, CommandQueue, read_command, sec2str, \
+    mm2nano, resp, _events, event_resp, err_resp, wrn_resp, path2uri, \
+    is_localpath, FileTempl, parse_sink_args, sink_args, RecordSweeper, \
+    Backoff, PostProcessor, CommonCommands, is_network_error, Engine, \
+    CLIPlayer, PLAYER_OPTIONS, player_options, run_postproc_job
+
+ENGINES = {"gst0.10": None, "gst1": "gaplay1.py"} # engine -> script
+
+def exec_engine(argv):
+  "Run other engine script by --engine (or --benchmark), before pygst import"
+  engine = "gst0.10"
+  for (i, arg) in enumerate(argv):
+    if arg.startswith("--engine="): engine = arg[len("--engine="):]
+    elif arg == "--engine" and i + 1 < len(argv): engine = argv[i + 1]
+  if engine not in ENGINES:
+    raise ValueError("unknown engine - %s (%s)" %
+                     (engine, "|".join(sorted(ENGINES.keys()))))
+  if "--benchmark" in argv: engine = "gst1" # compares both engines
+  if "--captures" in argv: return # capture daemon is gst0.10 only
+  if ENGINES[engine]:
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          ENGINES[engine])
+    os.execv(sys.executable, [sys.executable, script] + argv)
+
+if __name__ == "__main__":
+  try:
+    exec_engine(sys.argv[1:])
+  except (ValueError, OSError), exc:
+    sys.stdout.write("->ERROR %s - %s\n" % (_program, exc))
+    exit(2)
+
 import gobject 
 import pygst
 pygst.require("0.10")
 import gst
-
 import traceback
 
-LOAD_PLAYLIST_TIMEOUT = 30
-
-_isdebug = False
-#_isdebug = True
-
-def _puts(fmt, *args):
-  if _isdebug:
-    msg = fmt % args
-    sys.stdout.write(msg + "\n")
-    # log(msg)
+TIMESHIFT_MAX_BYTES = 64 * 1024 * 1024 # hard limit of time-shift buffer
+TIMESHIFT_FEED_INTERVAL = 100 # msec
+CAPTURE_MAX = 4              # max concurrent background captures
+CAPTURE_START_INTERVAL = 1000 # msec, between (re)starts of captures
+CAPTURE_STOP_TIMEOUT = 3000  # msec, wait for EOS to finalize wav file
+GST_LAUNCH = "gst-launch-0.10"
+TIMESHIFT_CAPS = ("audio/x-raw-int, endianness=1234, signed=true,"
+                  " width=16, depth=16")
+# seek flags for each seek mode
+SEEK_FLAGS = {
+  "normal": gst.SEEK_FLAG_FLUSH,
+  # scrubbing: decode from nearest keyframe only
+  "scrub": gst.SEEK_FLAG_FLUSH | gst.SEEK_FLAG_KEY_UNIT | \
+      getattr(gst, "SEEK_FLAG_SNAP_NEAREST", 0),
+  "accurate": gst.SEEK_FLAG_FLUSH | gst.SEEK_FLAG_ACCURATE,
+}
 
 def log(msg): # for debug
   import datetime
@@ -41,118 +78,577 @@ def log(msg): # for debug
     with open("/tmp/gaplay.log","a") as f:
       f.write("%s %s\n" % (datetime.datetime.now().ctime(), msg))
 
-class CommandQueue(object) :
-  def __init__(self):
+def new_audiosink(conf, name=None):
+  "Create audio sink by conf (see SINK_DEFAULT) in a bin, see set_level"
+  asink = gst.element_factory_make(conf["element"], "audiosink")
+  def configure(elem):
+    props = [pspec.name for pspec in gobject.list_properties(elem)]
+    for key in ("device", "buffer-time", "latency-time"):
+      if (conf.get(key) is not None) and (key in props):
+        elem.set_property(key, conf[key])
+  configure(asink)
+  if isinstance(asink, gst.Bin): # e.g. autoaudiosink creates actual sink later
+    asink.connect("element-added", lambda bin, elem: configure(elem))
+  sinkbin = gst.Bin(name) if name else gst.Bin()
+  sinkbin.add(asink)
+  sinkbin.add_pad(gst.GhostPad("sink", asink.get_pad("sink")))
+  set_level(sinkbin, conf.get("level"))
+  return sinkbin
+
+def set_level(sinkbin, interval):
+  '''Meter sinkbin every interval msec by level element, None removes it.
+While data flows, relinked when the upstream pad is blocked, so that the
+pipeline keeps its state.'''
+  sinkbin.set_data("level", interval)
+  if bool(sinkbin.get_by_name("level")) == bool(interval):
+    relink_level(sinkbin) # no relinking, interval only
+    return
+  peer = sinkbin.get_pad("sink").get_peer()
+  if peer and peer.is_active(): # may be streaming
+    def blocked(pad, is_blocked):
+      if not is_blocked: return
+      try: relink_level(sinkbin) # in streaming thread
+      finally: pad.set_blocked_async(False, lambda *args: None)
+    peer.set_blocked_async(True, blocked)
+  else: relink_level(sinkbin)
+
+def relink_level(sinkbin):
+  "Insert, remove or update level element by interval of set_level"
+  interval = sinkbin.get_data("level")
+  (ghost, asink) = (sinkbin.get_pad("sink"), sinkbin.get_by_name("audiosink"))
+  level = sinkbin.get_by_name("level")
+  if interval and not level:
+    level = gst.element_factory_make("level", "level")
+    sinkbin.add(level)
+    ghost.set_target(None)
+    level.link(asink)
+    ghost.set_target(level.get_pad("sink"))
+    level.sync_state_with_parent()
+  elif level and not interval:
+    ghost.set_target(None)
+    level.unlink(asink)
+    ghost.set_target(asink.get_pad("sink"))
+    level.set_state(gst.STATE_NULL)
+    sinkbin.remove(level)
+  if interval:
+    level.set_property("interval", long(interval) * 1000000)
+    level.set_property("message", True)
+
+def level_resp(message):
+  "Report message of level element, returns False for other messages"
+  st = message.structure
+  if (st is None) or (st.get_name() != "level"): return False
+  if _events.wants("level"):
+    event_resp("level", "LEVEL",
+               "peak=" + ",".join("%.1f" % db for db in st["peak"]),
+               "rms=" + ",".join("%.1f" % db for db in st["rms"]))
+  return True
+
+# Raw audio (TIMESHIFT_CAPS) addressed by byte offset from stream start.
+# Oldest chunks are dropped to keep `seconds' and `max_bytes' limits.
+class TimeShiftRing(object):
+  def __init__(self, seconds, max_bytes=TIMESHIFT_MAX_BYTES):
     self.lock = threading.Lock()
-    self.cmdlist = []
-  
-  def add(self, command):
+    (self.seconds, self.max_bytes) = (seconds, max_bytes)
+    (self.rate, self.channels, self.byterate) = (0, 0, 0)
+    (self.offsets, self.chunks) = ([], [])
+    self.end = 0
+    self.generation = 0 # incremented when cleared
+
+  def _clear(self):
+    (self.offsets, self.chunks) = ([], [])
+    self.generation += 1
+
+  def clear(self):
+    with self.lock: self._clear()
+
+  def start(self):
     with self.lock:
-      # time.sleep(1) # for debug
-      self.cmdlist.append(command)
+      return self.offsets[0] if self.offsets else self.end
 
-  def get(self, fallback=None):
+  def set_format(self, rate, channels):
+    "Returns True if format is changed (and ring is cleared)"
     with self.lock:
-      try:
-        cmd = self.cmdlist.pop(0)
-      except IndexError:
-        cmd = fallback
-    return cmd
+      if (rate, channels) == (self.rate, self.channels): return False
+      (self.rate, self.channels) = (rate, channels)
+      self.byterate = rate * channels * 2
+      self._clear()
+      return True
 
-def read_command(cmdqueue):
-  time.sleep(0.5)
-  try:
+  def append(self, data):
+    with self.lock:
+      self.offsets.append(self.end)
+      self.chunks.append(data)
+      self.end += len(data)
+      limit = self.max_bytes
+      if self.byterate: limit = min(limit, self.seconds * self.byterate)
+      drop = 0
+      while (drop < len(self.chunks) - 1) and \
+            (self.end - self.offsets[drop] > limit):
+        drop += 1
+      if drop:
+        del self.offsets[:drop]
+        del self.chunks[:drop]
+
+  def read(self, pos, size):
+    "Returns (next-pos, data), data is empty when pos reaches the end"
+    with self.lock:
+      if self.offsets: pos = max(pos, self.offsets[0])
+      if pos >= self.end: return (pos, "")
+      i = bisect.bisect_right(self.offsets, pos) - 1
+      (parts, n) = ([], 0)
+      while (i < len(self.chunks)) and (n < size):
+        skip = pos + n - self.offsets[i]
+        part = self.chunks[i][skip:skip + size - n]
+        parts.append(part)
+        n += len(part)
+        i += 1
+      return (pos + n, "".join(parts))
+
+  def clamp(self, pos):
+    "Returns pos within the ring and aligned to the frame"
+    with self.lock:
+      start = self.offsets[0] if self.offsets else self.end
+      pos = min(self.end, max(start, pos))
+      return pos - (pos - start) % ((self.channels * 2) or 1)
+
+  def nano2bytes(self, nano):
+    return nano * self.byterate // 1000000000
+
+  def bytes2nano(self, nbytes):
+    if not self.byterate: return 0
+    return nbytes * 1000000000 // self.byterate
+
+# Time-shift of live stream.
+# playbin2 renders decoded audio into `capsink' which stores it to the ring,
+# and `output' pipeline plays the ring from `cursor'.
+class TimeShift(object):
+  def __init__(self, seconds, rec_end=lambda path: None, sink_conf=SINK_DEFAULT):
+    self.ring = TimeShiftRing(seconds)
+    self.sink_conf = sink_conf
+    self.rec_end = rec_end # called with file closed by rotate_record
+    self.generation = self.ring.generation
+    self.cursor = 0  # ring offset of next output
+    self.outtime = 0 # timestamp of next output buffer
+    (self.paused, self.need_data) = (False, False)
+    self.rec = None  # [wave-writer, path, ring-offset, templ]
+    self.handlers = [] # (gobject, handler-id) disconnected by close
+    self.capsink = self.new_capsink()
+    self.output = self.new_output()
+    self.feed_id = None
+
+  def new_capsink(self):
+    aconverter = gst.element_factory_make("audioconvert")
+    capsfilter = gst.element_factory_make("capsfilter")
+    capsfilter.set_property("caps", gst.Caps(TIMESHIFT_CAPS))
+    appsink = gst.element_factory_make("appsink", "tsink")
+    appsink.set_property("emit-signals", True)
+    appsink.set_property("sync", True)
+    self.handlers.append(
+      (appsink, appsink.connect("new-buffer", self.on_new_buffer)))
+    capsink = gst.Bin("timeshift-sink")
+    capsink.add(aconverter, capsfilter, appsink)
+    gst.element_link_many(aconverter, capsfilter, appsink)
+    capsink.add_pad(gst.GhostPad("sink", aconverter.get_pad("sink")))
+    return capsink
+
+  def new_output(self):
+    self.appsrc = gst.element_factory_make("appsrc", "tsrc")
+    self.appsrc.set_property("format", gst.FORMAT_TIME)
+    for sig, func in (("need-data", self.on_need_data),
+                      ("enough-data", self.on_enough_data)):
+      self.handlers.append((self.appsrc, self.appsrc.connect(sig, func)))
+    aconverter = gst.element_factory_make("audioconvert")
+    self.resampler = gst.element_factory_make("audioresample")
+    self.asink = new_audiosink(self.sink_conf, "tsasink")
+    output = gst.Pipeline("timeshift-output")
+    output.add(self.appsrc, aconverter, self.resampler, self.asink)
+    gst.element_link_many(self.appsrc, aconverter, self.resampler, self.asink)
+    bus = output.get_bus()
+    bus.add_signal_watch()
+    self.handlers.append((bus, bus.connect("message", self.on_message)))
+    return output
+
+  def start(self):
+    self.feed_id = gobject.timeout_add(TIMESHIFT_FEED_INTERVAL, self.feed)
+
+  def replace_sink(self, conf):
+    self.output.set_state(gst.STATE_NULL)
+    self.output.remove(self.asink)
+    self.sink_conf = conf
+    self.asink = new_audiosink(conf, "tsasink")
+    self.output.add(self.asink)
+    self.resampler.link(self.asink)
+    self.restart_output()
+
+  def close(self):
+    "Returns closed recording file or None"
+    if self.feed_id is not None:
+      gobject.source_remove(self.feed_id)
+      self.feed_id = None
+    self.output.set_state(gst.STATE_NULL)
+    f = self.stop_record()
+    # break the cycles through signal handlers, or self and ring never die
+    self.output.get_bus().remove_signal_watch()
+    for obj, hid in self.handlers: obj.disconnect(hid)
+    self.handlers = []
+    self.ring.clear()
+    return f
+
+  # called in streaming thread
+  def on_new_buffer(self, appsink):
+    buf = appsink.emit("pull-buffer")
+    if buf is None: return
+    caps = buf.get_caps() or appsink.get_pad("sink").get_negotiated_caps()
+    if caps:
+      self.ring.set_format(caps[0]["rate"], caps[0]["channels"])
+    self.ring.append(buf.data)
+
+  def on_need_data(self, appsrc, size): self.need_data = True
+  def on_enough_data(self, appsrc): self.need_data = False
+
+  def on_message(self, bus, message):
+    if message.type == gst.MESSAGE_ERROR:
+      err, debug = message.parse_error()
+      if _isdebug: err_resp("time-shift output %s - %s" % (err, debug))
+      else: err_resp("time-shift output %s" % err)
+    elif message.type == gst.MESSAGE_ELEMENT:
+      level_resp(message)
+
+  def restart_output(self):
+    "Discard queued output and continue from cursor"
+    self.output.set_state(gst.STATE_READY)
+    (self.need_data, self.outtime) = (False, 0)
+    if self.ring.rate:
+      self.appsrc.set_property("caps", gst.Caps(
+          "%s, rate=%d, channels=%d" % (TIMESHIFT_CAPS, self.ring.rate,
+                                        self.ring.channels)))
+      if not self.paused: self.output.set_state(gst.STATE_PLAYING)
+
+  def flush(self):
+    "Discard buffered audio, e.g. after seeking the source"
+    self.ring.clear()
+
+  def feed(self):
+    ring = self.ring
+    if self.generation != ring.generation: # cleared or format changed
+      self.generation = ring.generation
+      self.cursor = ring.start()
+      if self.rec: self.rotate_record()
+      self.restart_output()
+    if self.rec: self.write_record()
+    if self.paused or (not ring.rate): return True
+    start = ring.start()
+    if self.cursor < start:
+      wrn_resp("time-shift buffer overrun")
+      self.cursor = start
+    for _ in xrange(4):
+      if not self.need_data: break
+      (self.cursor, data) = ring.read(self.cursor, ring.byterate // 10)
+      if not data: break
+      buf = gst.Buffer(data)
+      buf.timestamp = self.outtime
+      buf.duration = ring.bytes2nano(len(data))
+      self.outtime += buf.duration
+      self.appsrc.emit("push-buffer", buf)
+    return True
+
+  def delay(self):
+    "Nanoseconds from output cursor to live edge"
+    return self.ring.bytes2nano(self.ring.end - self.cursor)
+
+  def set_delay(self, nano):
+    "Returns actual delay"
+    ring = self.ring
+    self.cursor = ring.clamp(ring.end - ring.nano2bytes(max(0, nano)))
+    self.restart_output()
+    return self.delay()
+
+  def set_paused(self, paused):
+    self.paused = paused
+    if paused: self.output.set_state(gst.STATE_PAUSED)
+    elif self.ring.rate: self.output.set_state(gst.STATE_PLAYING)
+
+  def start_record(self, templ, preroll_nano):
+    "Record from preroll_nano before cursor, returns recording file"
+    ring = self.ring
+    if not ring.rate: raise IOError("time-shift buffer is empty")
+    path = templ.nextfile()
+    writer = wave.open(path, "wb")
+    writer.setnchannels(ring.channels)
+    writer.setsampwidth(2)
+    writer.setframerate(ring.rate)
+    pos = ring.clamp(self.cursor - ring.nano2bytes(preroll_nano))
+    self.rec = [writer, path, pos, templ]
+    return path
+
+  def write_record(self):
+    (writer, pos) = (self.rec[0], self.rec[2])
     while True:
-      #time.sleep(0.2)
-      line = sys.stdin.readline()
-      if not line: cmdline = ["quit"]
-      else : cmdline = line.strip().split(None, 1)
-      if len(cmdline) > 0:
-        _puts("read_command cmdline=%s thread=%s", cmdline, threading.currentThread())
-        cmdqueue.add(cmdline)
-        if cmdline[0] == "quit": break
-  except IOError, exc:
-    _puts("read_command IOError - %s", exc)
-    cmdqueue.add(["error", str(exc)])
-    cmdqueue.add(["quit"])
-
-def sec2str(sec):
-  (h, m) = divmod(sec, 3600)
-  (m, s) = divmod(m, 60)
-  if h: return "%02d:%02d:%02d" % (h, m, s)
-  return "%02d:%02d" % (m, s)
-
-def mm2nano(msec):
-  return msec * 1000000
-
-# Return value is rounded off to the decimal place
-def nano2sec(nano, isround=True):
-  return (nano + (500000000 if isround else 0) ) // 1000000000
-
-def to_s(s):
-  if isinstance(s,str): return s
-  elif isinstance(s, unicode): return s.encode("utf-8", "replace")
-  elif s is None: return "none"
-  return str(s)
-
-def resp(title, *msgs):
-  sys.stdout.write("->" + title)
-  if msgs:
-    sys.stdout.write(" " + " ".join( (to_s(s) for s in msgs) ))
-  sys.stdout.write("\n")
-
-def err_resp(*msgs): resp("ERROR", *msgs)
-def wrn_resp(*msgs): resp("WARNING", *msgs)
-
-def match_uri(path, _rx=re.compile(r'(\w+)://')):
-  return _rx.match(path)
-
-def match_uri2(path, _rx=re.compile(r'''(http|https|ftp)://''', re.I)):
-  "is match http or https or ftp"
-  return _rx.match(path)
-
-def match_http(path, _rx=re.compile(r'''https?://''', re.I)):
-  return _rx.match(path)
-
-def is_localpath(path):
-  m = match_uri(path)
-  if m:
-    return m.group(1).lower() in ("file", "dvd", "cdda")
-  return True
+      (pos, data) = self.ring.read(pos, 1 << 16)
+      if not data: break
+      writer.writeframesraw(data)
+    self.rec[2] = pos
+
+  def stop_record(self):
+    if not self.rec: return None
+    self.write_record()
+    (writer, path) = self.rec[:2]
+    self.rec = None
+    writer.close()
+    return path
+
+  def rotate_record(self):
+    "Continue recording with next file when audio format is changed"
+    templ = self.rec[3]
+    self.rec[0].close()
+    self.rec_end(self.rec[1])
+    self.rec = None
+    event_resp("rec", "REC", "start", self.start_record(templ, 0))
+
+def capture_error(name, msg):
+  "Failure of a capture, not ERROR which makes the client disconnect"
+  resp("CAPTURE", "error", name, msg)
+
+# Background recording of a stream into `~/.gaplay/NAME-%Y-%m-%d.wav'
+# by own playbin2 without audio output.
+class Capture(object):
+  def __init__(self, manager, name, uri):
+    (self.manager, self.name, self.uri) = (manager, name, uri)
+    self.templ = FileTempl("~/.gaplay/%s-%%Y-%%m-%%d.wav" % name)
+    if manager.sweeper: manager.sweeper.add(self.templ)
+    self.state = "waiting" # waiting|running|stopping
+    (self.path, self.started, self.running_since) = (None, None, None)
+    self.tags = dict()
+    self.backoff = Backoff()
+    (self.retry_id, self.stop_id) = (None, None)
+
+    self.pipeline = gst.element_factory_make("playbin2", "capture-%s" % name)
+    self.pipeline.set_property("video-sink",
+                               gst.element_factory_make("fakesink"))
+    self.pipeline.set_property("flags", 0x0002) # audio only
+    self.pipeline.set_property("uri", uri)
+    aconverter = gst.element_factory_make("audioconvert")
+    encoder = gst.element_factory_make("wavenc")
+    self.fsink = gst.element_factory_make("filesink")
+    sink = gst.Bin("capture-sink")
+    sink.add(aconverter, encoder, self.fsink)
+    gst.element_link_many(aconverter, encoder, self.fsink)
+    sink.add_pad(gst.GhostPad("sink", aconverter.get_pad("sink")))
+    self.pipeline.set_property("audio-sink", sink)
+
+    bus = self.pipeline.get_bus()
+    bus.add_signal_watch()
+    self.bus_id = bus.connect("message", self.on_message)
+
+  def start(self):
+    self.retry_id = None
+    if self.state != "waiting": return
+    self.path = self.templ.nextfile()
+    self.fsink.set_property("location", self.path)
+    self.state = "running"
+    self.running_since = time.time()
+    if self.started is None: self.started = self.running_since
+    self.pipeline.set_state(gst.STATE_PLAYING)
+    event_resp("rec", "CAPTURE", "start", self.name, self.path)
+
+  def close_file(self):
+    self.pipeline.set_state(gst.STATE_NULL)
+    if self.path:
+      event_resp("rec", "CAPTURE", "end", self.name, self.path)
+      if self.manager.postproc:
+        self.manager.postproc.submit(self.path, self.tags)
+      self.path = None
+
+  def retry(self, reason):
+    "Restart after backoff delay, returns False when gave up"
+    self.close_file()
+    if time.time() - (self.running_since or 0) >= RECONNECT_STABLE:
+      self.backoff.reset()
+    if self.backoff.exhausted(): return False
+    delay = self.backoff.next_delay()
+    self.state = "waiting"
+    event_resp("rec", "CAPTURE", "reconnect", self.name,
+               self.backoff.attempts, "%.1f" % delay, reason)
+    self.retry_id = gobject.timeout_add(
+      int(delay * 1000), self.manager.enqueue, self)
+    return True
+
+  def stop(self, sync=False):
+    "Finish with EOS so that wavenc can complete the header"
+    if self.state != "running":
+      self.finish()
+      return
+    self.state = "stopping"
+    self.pipeline.send_event(gst.event_new_eos())
+    if sync:
+      self.pipeline.get_bus().timed_pop_filtered(
+        mm2nano(CAPTURE_STOP_TIMEOUT), gst.MESSAGE_EOS | gst.MESSAGE_ERROR)
+      self.finish()
+    else:
+      self.stop_id = gobject.timeout_add(CAPTURE_STOP_TIMEOUT, self.finish)
+
+  def finish(self):
+    for sid in (self.retry_id, self.stop_id):
+      if sid is not None: gobject.source_remove(sid)
+    (self.retry_id, self.stop_id) = (None, None)
+    self.close_file()
+    if self.bus_id is not None: # or the bus keeps self and pipeline
+      bus = self.pipeline.get_bus()
+      bus.remove_signal_watch()
+      bus.disconnect(self.bus_id)
+      self.bus_id = None
+    self.manager.remove(self)
+    event_resp("rec", "CAPTURE", "stop", self.name)
+    return False
+
+  def status(self):
+    size = -1
+    if self.path:
+      try: size = os.path.getsize(self.path)
+      except OSError: pass
+    elapsed = int(time.time() - self.started) if self.started else 0
+    return (self.name, self.state, sec2str(elapsed),
+            "%dKB" % (size // 1024) if size >= 0 else "-",
+            self.path or "-", self.uri)
+
+  def on_message(self, bus, message):
+    try:
+      mtype = message.type
+      if mtype == gst.MESSAGE_EOS:
+        # remote server closed the stream unless we stop it
+        if self.state == "stopping" or is_localpath(self.uri) or \
+              not self.retry("eos"):
+          self.finish()
+      elif mtype == gst.MESSAGE_TAG:
+        tags = message.parse_tag()
+        for k in POSTPROC_TAGS:
+          if (k in tags.keys()) and isinstance(tags[k], basestring):
+            self.tags[k] = tags[k]
+      elif mtype == gst.MESSAGE_ERROR:
+        err, debug = message.parse_error()
+        if self.state != "running": return
+        if is_network_error(err, self.uri, _NET_RESOURCE_ERRORS):
+          wrn_resp("capture %s - %s" % (self.name, err))
+          if self.retry("error"): return
+        capture_error(self.name, err)
+        self.finish()
+    except Exception, exc:
+      wrn_resp("capture on_message - %s" % exc)
+
+# Captures share CAPTURE_MAX limit and are (re)started one by one
+# every CAPTURE_START_INTERVAL msec.
+class CaptureManager(object):
+  def __init__(self, sweeper=None, postproc=None, maxcaptures=CAPTURE_MAX):
+    (self.sweeper, self.postproc) = (sweeper, postproc)
+    self.maxcaptures = maxcaptures
+    self.captures = dict()
+    self.pending = []
+    self.timer_id = None
+
+  def add(self, name, uri):
+    if not re.match(r'[-\w.]+\Z', name):
+      raise ValueError("illegal capture name - %s" % name)
+    if name in self.captures:
+      raise ValueError("capture `%s' already exists" % name)
+    if len(self.captures) >= self.maxcaptures:
+      raise ValueError("too many captures (max %d)" % self.maxcaptures)
+    cap = Capture(self, name, uri)
+    self.captures[name] = cap
+    self.enqueue(cap)
+
+  def enqueue(self, cap):
+    self.pending.append(cap)
+    if self.timer_id is None:
+      self.timer_id = gobject.idle_add(self.start_next)
+    return False
+
+  def start_next(self):
+    while self.pending:
+      cap = self.pending.pop(0)
+      if self.captures.get(cap.name) is cap:
+        try: cap.start()
+        except (IOError, OSError), exc:
+          capture_error(cap.name, exc)
+          cap.finish()
+        break
+    if self.pending:
+      self.timer_id = gobject.timeout_add(CAPTURE_START_INTERVAL,
+                                          self.start_next)
+    else: self.timer_id = None
+    return False
+
+  def remove(self, cap):
+    if self.captures.get(cap.name) is cap:
+      del self.captures[cap.name]
+
+  def stop(self, name):
+    cap = self.captures.get(name)
+    if not cap: raise KeyError("no such capture - %s" % name)
+    cap.stop()
+
+  def stop_all(self):
+    for cap in self.captures.values(): cap.stop(sync=True)
+
+  def report(self):
+    resp("CAPTURE", "count", len(self.captures), "max=%d" % self.maxcaptures)
+    for name in sorted(self.captures.keys()):
+      resp("CAPTURE", "status", *self.captures[name].status())
+
+# `gaplay.py --captures': background captures in a long-lived process
+# of their own, since the client restarts the player on every track.
+class CaptureDaemon(CommonCommands):
+  def __init__(self, cmdqueue):
+    self.dispatch_table = {
+      "capture":self.capture_command, "quit":self.quit,
+      "retention":self.retention_command,
+      "postproc":self.postproc_command,
+      "subscribe":self.subscribe_command,
+      "unsubscribe":self.unsubscribe_command,
+      }
+    self.cmdqueue = cmdqueue
+    self.sweeper = RecordSweeper(self.recfiles_in_use, gobject.idle_add)
+    self.postproc = PostProcessor(os.path.abspath(__file__), gobject.idle_add)
+    self.captures = CaptureManager(self.sweeper, self.postproc)
+
+  def recfiles_in_use(self):
+    "Called by sweeper thread"
+    return [cap.path for cap in self.captures.captures.values() if cap.path]
 
-# example
-#  t = FileTempl("~/.gaplay/rec%Y-%m-%d.wav")
-#  fname = t.nextfile() ; fname #=> '/Users/tetsu/.gaplay/rec2012-08-28.wav'
-#  with open(fname,"w") as f : pass
-#  fname = t.nextfile() ; fname #=> '/Users/tetsu/.gaplay/rec2012-08-28-1.wav'
-class FileTempl(object):
-  def __init__(self, templ, date_convert=True):
-    self.templ = os.path.abspath( os.path.expanduser(templ) )
-    self.date_convert = date_convert
-  #
-  def nextfile(self, create_dir=True):
-    # Replace with strftime
-    if self.date_convert:
-      fname = datetime.date.today().strftime(self.templ)
-    else: fname = self.templ
-    # Create dirs
-    dirpath = os.path.dirname(fname)
-    if not os.path.exists(dirpath):
-      if create_dir: os.makedirs(dirpath)
-    elif not os.path.isdir(dirpath):
-      raise IOError("Fail to create a directory `%s'" % dirpath)
-
-    if not os.path.exists(fname):
-      return fname
-    (base, ext) = os.path.splitext(fname)
-    for n in xrange(1, sys.maxint):
-      name = "".join((base, ("-%d" % n), ext))
-      _puts("FileTempl#nextfile name=%s",name)
-      if not os.path.exists(name): return name
-    raise IOError("Fail to create recording file")
-
-(_LOADING, _LOADED, _PLAYING, _PLAYED, _STOPPING, _STOPPED,
- _PAUSING, _PAUSED ) = range(1, 9)
+  def capture_command(self, args=[]):
+    argv = args and args[0].split(None, 2)
+    subcmd = argv[0] if argv else "status"
+    try:
+      if subcmd == "start" and len(argv) == 3:
+        uri = path2uri(argv[2])
+        if not uri:
+          err_resp("No such file - %s" % argv[2])
+          return
+        self.captures.add(argv[1], uri)
+      elif subcmd == "stop" and len(argv) == 2:
+        self.captures.stop(argv[1])
+      elif subcmd == "status" and len(argv) <= 1:
+        self.captures.report()
+      else:
+        err_resp("usage: capture [status|start NAME URI|stop NAME]")
+    except (ValueError, KeyError, IOError), exc:
+      err_resp("fail to capture - %s" % exc.args[0])
+
+  def quit(self, args=[]):
+    self.captures.stop_all()
+    loop.quit()
+
+  def dispatch_command(self):
+    cmdline = self.cmdqueue.get()
+    while cmdline:
+      cmdop = self.dispatch_table.get(cmdline[0])
+      try:
+        if cmdop: cmdop(cmdline[1:])
+        else: err_resp("Illegal command - %s" % cmdline[0])
+      except Exception, exc:
+        err_resp("fail to dispatch_command: %s - %s" % (exc, cmdline))
+      cmdline = self.cmdqueue.get()
+    return True
 
 _STATE_TAB = dict((gst.element_state_get_name(state), state)
                   for state in (gst.STATE_NULL, gst.STATE_READY, gst.STATE_PAUSED,
@@ -167,37 +663,31 @@ _STATE_CHANGE_TAB = {gst.STATE_CHANGE_SUCCESS:"SUCCESS",
                      gst.STATE_CHANGE_NO_PREROLL:"PREROLL"}
 def state_change2str(v):
   return _STATE_CHANGE_TAB.get(v, "UNKNOWN")
-  
-class CLIPlayer(object):
-
-  def __init__(self, cmdqueue):
-    self.dispatch_table = {
-      "load":self.load_command, "quit":self.quit, 
-      "play":self.play_command, "stop":self.stop_command,
-      "_pause":self.pause_command, "_resume":self.resume_command,
-      "pause":self.toggle_pause, "replay":self.replay_command,
-      "rec":self.toggle_record, "gain":self.gain,
-      "skip":self.skip_command, "jump":self.jump_command,
-      "load-http":self.load_http,
-      "load-shoutcast":self.load_shoutcast,
-      "state":self.state_command, "info":self.info,
-      "error":self.error_command, 
-      "raise":self.raise_command, # for debug
-      "warning":self.warning_command, # for debug
-      }
 
-    self.cmdqueue = cmdqueue
-    # playmode _STOPPED|_PLAYING|_PAUSED
-    self.requests = set()
-    self.recfile_templ = FileTempl("~/.gaplay/rec%Y-%m-%d.wav")
-    self.paused = False
-    self.paused_pos = -1
-    self.asink_org = None
+_NET_RESOURCE_ERRORS = tuple(getattr(gst, name) for name in (
+    "RESOURCE_ERROR_NOT_FOUND", "RESOURCE_ERROR_OPEN_READ",
+    "RESOURCE_ERROR_READ", "RESOURCE_ERROR_SEEK") if hasattr(gst, name))
+
+# GStreamer 0.10 engine of CLIPlayer by playbin2, see Engine.
+class Engine010(Engine):
+  name = "gst0.10"
+  script = os.path.abspath(__file__)
+  gst_launch = GST_LAUNCH
+  decodebin = "decodebin2"
+  features = ("timeshift", "level")
+
+  def __init__(self, sink_conf=SINK_DEFAULT):
+    (self.idle_add, self.timeout_add, self.source_remove) = (
+      gobject.idle_add, gobject.timeout_add, gobject.source_remove)
+    self.sink_conf = sink_conf
+    self.asink_org = new_audiosink(sink_conf, "asink-org")
+    self.tshift = None
 
     self.player = gst.element_factory_make("playbin2", "player")
     self.player.set_property("video-sink", 
                              gst.element_factory_make("fakesink", "fakevideo"))
     self.player.set_property("flags", 0x0012) # soft-volume+audio, not video and text
+    self.player.set_property("audio-sink", self.asink_org)
     ##self.player.set_property("flags", 0x0016) # soft-volume+text+audio, not video
 
     self.recsink = self.new_recsink()
@@ -213,7 +703,7 @@ class CLIPlayer(object):
     queue_a = gst.element_factory_make("queue", "queue-a")
     queue_f = gst.element_factory_make("queue", "queue-f")
     fsink = gst.element_factory_make("filesink", "fsink")
-    asink = gst.element_factory_make("autoaudiosink", "asink")
+    asink = new_audiosink(self.sink_conf, "asink")
     encoder = gst.element_factory_make("wavenc")
     (wavfilter, aconverter) = (None, None)
     if bit_depth:
@@ -247,501 +737,103 @@ class CLIPlayer(object):
     ghostpad = gst.GhostPad("sink", pad_sink)
     recsink.add_pad(ghostpad)
     return recsink
-    
-  # If failed or cannot get_state (only strict=True) then retruns None
-  def get_state_list(self, tmout=mm2nano(500), strict=True):
-    stlist = self.player.get_state( timeout=tmout)
-    if stlist[0] == gst.STATE_CHANGE_FAILURE: return None
-    if strict and (stlist[0] == gst.STATE_CHANGE_ASYNC):
-      return None
-    return stlist[1:]
-
-  def has_state(self, state, tmout=mm2nano(500), strict=True):
-    stlist = self.get_state_list(tmout, strict)
-    if stlist is None: return False
-    return state in stlist
-
-  def query_duration(self, fallback=None):
-    try: 
-      return self.player.query_duration(gst.FORMAT_TIME, None)[0]
-    except Exception: # gst.QueryError, IndexError, TypeError
-      _puts("fail in query_duration")
-      return fallback
 
-  def query_position(self, fallback=None):
-    try: 
-      return self.player.query_position(gst.FORMAT_TIME, None)[0]
-    except Exception: # gst.QueryError, IndexError, TypeError
-      _puts("fail in query_position")
-      return fallback
+  def has_element(self, name):
+    return bool(gst.element_factory_find(name))
 
-  def recfile(self):
-    return self.recfile_templ.nextfile()
+  def uri(self):
+    return self.player.get_property("uri")
 
-  def is_recording(self):
-    return self.player.get_property("audio-sink") == self.recsink
+  def set_uri(self, uri):
+    self.player.set_property("uri", uri)
+    if self.player.get_property("uri") is None:
+      _puts("uri is not set soon") 
 
-  def update_recfile(self):
-    rfile = self.recfile()
-    self.fsink.set_property("location", rfile)
-    return rfile
+  def get_state(self, timeout=500):
+    (ret, state, pending) = self.player.get_state(timeout=mm2nano(timeout))
+    return (state_change2str(ret), state2str(state), state2str(pending))
 
-  def close_recfile(self):
-    location = self.fsink.get_property("location")
-    self.fsink.set_property("location", None)
-    return location
-
-  def load_command(self, args=[]):
-    filepath = args and args[0]
-    if not filepath:
-      err_resp("usage: load URL|FILEPATH")
-      return
-    if match_uri(filepath): uri = filepath
-    else:
-      # when filename was specified
-      abspath = os.path.abspath( os.path.expanduser(filepath) )
-      if not os.path.isfile(abspath):
-        err_resp("No such file - %s" % filepath)
-        return
-      uri = "file://" + urllib.pathname2url(abspath)
-    # self.player.set_state(gst.STATE_NULL) # no need (play->stop)
-    self.requests.add(_LOADING)
-    self.requests.add(_PLAYING)
-    if not self.play(uri):
-      self.requests.discard(_LOADING)
-      self.requests.discard(_PLAYING)
-
-  def play_command(self, args=[]):
-    self.requests.add(_PLAYING)
-    if not self.play():
-      self.requests.discard(_PLAYING)
+  def set_state(self, state):
+    return state_change2str(self.player.set_state(str2state(state)))
 
   # bug? (in os-x)
   #  set_state(STATE_NULL -> STATE_PLAYING) returns volume-value to 1.0 
-  def play_unchange_volume(self):
+  def play(self):
     vol = self.player.get_property("volume")
     if vol is not None: self.player.set_property("volume", vol)
     self.player.set_state(gst.STATE_PLAYING)
 
-  def play(self, uri=None):
-    self.stop()
-    if uri:
-      self.player.set_property("uri", uri)
-      if self.player.get_property("uri") is None:
-        _puts("uri is not set soon") 
-    if self.is_recording(): 
-      f = self.update_recfile()
-      resp("REC", "start", f)
-    # self.player.set_state(gst.STATE_PLAYING)
-    self.play_unchange_volume()
-    return True
-    
-  def stop_command(self, args=[]):
-    if self.stop(): resp("STOP")
-
-  def stop(self):
-    (self.paused, self.paused_pos) = (False, -1)
-    self.player.set_state(gst.STATE_NULL)
-    if self.is_recording():
-      f = self.close_recfile()
-      if f: resp("REC", "end", f)
-    return True
-      
-  def replay_command(self, args=[]):
-    self.stop_command(args)
-    self.play_command(args)
-    # Suppress `Warning: gsignal.c:2576: instance has no handler with id ...'
-    time.sleep(0.1)
-
-  def pause_command(self, args=[]):
-    self.requests.add(_PAUSING)
-    if not self.pause():
-      self.requests.discard(_PAUSING)
-
-  def pause(self):
-    if not self.has_state(gst.STATE_PLAYING):
-      wrn_resp("Fail to pause - not playing")
-      return False
-    self.paused = True
-    if self.query_duration(-1) > 0 :
-      self.paused_pos = self.query_position(-1)
-    else: self.paused_pos = -1
-
-    if self.is_recording():
-      self.player.set_state(gst.STATE_NULL)
-      f = self.close_recfile()
-      if f: resp("REC", "end", f)
-    else:
-      ret = self.player.set_state(gst.STATE_PAUSED)
-      if ret == gst.STATE_CHANGE_ASYNC:
-        _puts("Return STATE_CHANGE_ASYNC")
-    return True
+  def duration(self, fallback=-1):
+    try: 
+      return self.player.query_duration(gst.FORMAT_TIME, None)[0]
+    except Exception: # gst.QueryError, IndexError, TypeError
+      _puts("fail in query_duration")
+      return fallback
 
-  def resume_command(self, args=[]):
-    self.requests.add(_PLAYING)
-    if not self.resume():
-      self.requests.discard(_PLAYING)
-
-  def resume(self):
-    self.paused = False
-    if self.has_state(gst.STATE_PLAYING):
-      wrn_resp("Fail to resume - already playing")
-      return False
-    if self.has_state(gst.STATE_PAUSED):
-      self.paused_pos = -1
-      # not recording before paused
-      if self.is_recording():
-        err_resp("programing bug, will stop")
-        self.stop()
-        return False
-      self.player.set_state(gst.STATE_PLAYING)
-      return True
-    else:
-      if not self.has_state(gst.STATE_NULL):
-        wrn_resp("Has not NULL state and PAUSED state")
-      if self.is_recording():
-        f = self.update_recfile()
-        resp("REC", "start", f)
-      if self.paused_pos > 0:
-        self.player.set_state(gst.STATE_PAUSED)
-        time.sleep(0.2) # Fix-me MADA
-        self.player.seek_simple(gst.FORMAT_TIME, gst.SEEK_FLAG_FLUSH,
-                                self.paused_pos)
-      self.paused_pos = -1
-      #self.player.set_state(gst.STATE_PLAYING)
-      self.play_unchange_volume()
-      return True
+  def position(self, fallback=-1):
+    try: 
+      return self.player.query_position(gst.FORMAT_TIME, None)[0]
+    except Exception: # gst.QueryError, IndexError, TypeError
+      _puts("fail in query_position")
+      return fallback
 
-  def toggle_pause(self, args=[]):
-    stlist = (self.get_state_list() or [])
-    if gst.STATE_PLAYING in stlist:
-      # will pause
-      if self.paused: wrn_resp("Duplicated pause command")
-      if _PAUSING in self.requests: wrn_resp("Already pausing")
-
-      self.paused = True
-      if self.query_duration(-1) > 0 :
-        self.paused_pos = self.query_position(-1)
-      else: self.paused_pos = -1
-
-      self.requests.add(_PAUSING)
-      if self.is_recording():
-        self.player.set_state(gst.STATE_NULL)
-        f = self.close_recfile()
-        if f: resp("REC", "end", f)
-      else:
-        ret = self.player.set_state(gst.STATE_PAUSED)
-        if ret == gst.STATE_CHANGE_ASYNC:
-          wrn_resp("set_state returns STATE_CHANGE_ASYNC")
-      return True
+  def seek(self, nsec, mode="normal"):
+    return self.player.seek_simple(gst.FORMAT_TIME, SEEK_FLAGS[mode], nsec)
 
-    elif gst.STATE_PAUSED in stlist:
-      if _PLAYING in self.requests: wrn_resp("Already has playing-request")
-      # will resume play and not recording
-      (self.paused, self.paused_pos ) = (False , -1)
-      # not recording before paused
-      if self.is_recording():
-        err_resp("programing bug, will stop")
-        self.stop()
-        return False
-      self.requests.add(_PLAYING)
-      self.player.set_state(gst.STATE_PLAYING)
-      return True
+  def volume(self, vol=None):
+    if vol is not None: self.player.set_property("volume", vol)
+    return self.player.get_property("volume")
 
-    else:
-      if not gst.STATE_NULL in stlist: # When cannot gst.get_state
-        wrn_resp("player has not NULL or PAUSED or PLAYING state")
-      if _PLAYING in self.requests: wrn_resp("Already has playing-request")
-      # will resume to play after recording-pause or after stop
-      pos = self.paused_pos
-      (self.paused, self.paused_pos ) = (False , -1)
-
-      if self.is_recording():
-        f = self.update_recfile()
-        resp("REC", "start", f)
-
-      if pos > 0: # seek to just a paused positon
-        self.player.set_state(gst.STATE_PAUSED)
-        time.sleep(0.2) # Fix-me MADA
-        self.player.seek_simple(gst.FORMAT_TIME, gst.SEEK_FLAG_FLUSH, pos)
-      self.requests.add(_PLAYING)
-      #self.player.set_state(gst.STATE_PLAYING)
-      self.play_unchange_volume()
-      return True
-      
-  def toggle_record(self, args=[]):
-    pos = -1
-    playing = self.has_state(gst.STATE_PLAYING)
-    if playing:
-      if self.query_duration(-1) > 0:
-        pos = self.query_position(-1)
-
-    self.player.set_state(gst.STATE_NULL)
-    if self.is_recording():
-      f = self.close_recfile()
-      if f: resp("REC", "end", f)
-      asink = self.asink_org
-      if not asink:
-        if _isdebug: wrn_resp("Fail original audio sink, use `autoaudiosink'")
-        asink = gst.element_factory_make("autoaudiosink", "asink-org")
-      self.player.set_property("audio-sink", asink)
-      _puts("Stop recording")
-    else:
-      f = self.update_recfile()
-      self.player.set_property("audio-sink", self.recsink)
-      resp("REC", "start", f)
-      
-    if playing:
-      if pos >= 0:
-        self.player.set_state(gst.STATE_PAUSED)
-        time.sleep(0.2) # Fix-me MADA
-        self.player.seek_simple(gst.FORMAT_TIME, gst.SEEK_FLAG_FLUSH, pos)
-      #self.player.set_state(gst.STATE_PLAYING)
-      self.play_unchange_volume()
+  def latency(self):
+    "Returns latency (nanosec) of audio output pipeline or None"
+    pipeline = self.tshift.output if self.tshift else self.player
+    try:
+      query = gst.query_new_latency()
+      if pipeline.query(query): return query.parse_latency()[1]
+    except Exception, exc: # gst.QueryError, AttributeError
+      _puts("fail in query_latency - %s", exc)
+    return None
 
-  def quit(self, args=[]):
-    self.stop_command()
-    time.sleep(0.2) # no need
-    loop.quit()
-    
-  def gain(self, args=[]):
-    if args:
-      self.player.set_property("volume", float(args[0]))
-    resp("GAIN", self.player.get_property("volume"))
-    
-  def show_state(self): # for debug
-    states = self.player.get_state( timeout=mm2nano(500))
-    if states:
-      resp("STATE", state_change2str(states[0]),
-           tuple(state2str(s) for s in states[1:]))
-    else: resp("STATE", "none")
-
-  def info(self, args=[]):
-    uri = self.player.get_property("uri")
-    volume = self.player.get_property("volume")
-    resp("INFO", "uri=%s gain=%s" % ( (uri or "none"), volume))
-    if _isdebug:
-      self.show_state()
-      resp("REQS", tuple(self.requests))
-
-  def seek(self, nsec, incremental=False):
-    if self.is_recording():
-      wrn_resp("cannot seek when recording")
-      return
-    if not self.has_state(gst.STATE_NULL):
-      (dur, pos) = (self.query_duration(-1), self.query_position(-1))
-      if dur > 0 and pos >= 0 :
-        if incremental: nsec = pos + nsec
-        newpos = min(dur, max(0, nsec))
-        if self.player.seek_simple(gst.FORMAT_TIME, gst.SEEK_FLAG_FLUSH, newpos):
-          resp("SEEK", "%s/%s" % (sec2str( nano2sec(newpos) ),
-                                  sec2str( nano2sec(dur))))
-        else:
-          err_resp("fail to seek")
-      else:
-        wrn_resp("cannot seek")
-    else:
-      wrn_resp("fail to seek - not playing")
+  def is_recording(self):
+    return self.player.get_property("audio-sink") == self.recsink
 
-  def skip_command(self, args=[]):
-    sec = args and int( args[0] )
-    if not sec:
-      err_resp("usage: skip SEC")
-      return
-    return self.seek(sec * 1000000000, True)
+  def set_recording(self, on):
+    self.player.set_property("audio-sink",
+                             self.recsink if on else self.asink_org)
 
-  def jump_command(self, args=[]):
-    sec = args and int( args[0] )
-    if (not sec) and (sec != 0):
-      err_resp("usage: jump SEC")
-      return
-    return self.seek(sec * 1000000000, False)
-      
-  def raise_command(self, args=[]):  # for debug
-    raise Exception(*args)
-
-  def error_command(self, args=[]): 
-    err_resp(*args)
-
-  def warning_command(self, args=[]): 
-    wrn_resp(*args)
-
-  def state_command(self, args=[]):  # for debug
-    skey = args and args[0]
-    if skey:
-      state = str2state(skey)
-      if state:
-        _puts("begin set_state %s", skey)
-        ret = self.player.set_state(state)
-        _puts("end set_state %s", skey)
-        if ret == gst.STATE_CHANGE_ASYNC:
-          _puts("Return STATE_CHANGE_ASYNC")
-      else: err_resp("No state key - %s" % skey)
-    self.show_state()
-
-  def load_http(self, args=[]):
-    uri = args and args[0]
-    if not uri:
-      err_resp("usage: load-http URL")
-      return
-    if match_http(uri):
-      plsinfo = get_playlist(uri, False, timeout=LOAD_PLAYLIST_TIMEOUT)
-      if isinstance(plsinfo, dict):
-        resp("PLAYLIST-BEGIN", plsinfo.get("_type","-"), uri)
-        for num, entry in enumerate(plsinfo.get("_entries", [])):
-          num = num + 1
-          if entry.get("file"): resp(">", num, "path", entry.get("file",""))
-          if entry.get("length"): resp(">", num, "duration %d" % entry.get("length",-1))
-          if entry.get("title"): resp(">", num, "title", entry.get("title",""))
-        resp("PLAYLIST-END")
-        return
-    self.load_command(args)
-
-  def load_shoutcast(self, args=[]):
-    (entrynum, plspath) = args[0].split(None,1)
-    entrynum = int(entrynum)
-    if not match_uri(plspath): # convert to abspath when localpath 
-      plspath = os.path.abspath( os.path.expanduser(plspath) )
-
-    # Get playlist contents
-    plsinfo = get_playlist(plspath, True, timeout=LOAD_PLAYLIST_TIMEOUT)
-    entries = plsinfo.get("_entries")
-    if not entries:
-      wrn_resp("playlist has no entry - %s" % plspath)
-      return
-    # Select playlist entry
-    if entrynum == 0:
-      entrynum = random.randrange(1,len(entries)+1)
-    elif entrynum > 0:
-      entrynum = min(entrynum, len(entries))
-    else:
-      entrynum = len(entries)
-    entry = entries[entrynum - 1]
+  def rec_location(self):
+    return self.fsink.get_property("location")
 
-    loadpath = entry.get("file")
-    if not loadpath:
-      wrn_resp("playlist entry has not `file' attribute")
-      return
-    if match_uri2(plspath): # http|https|ftp playlist
-      if is_localpath(loadpath):
-        wrn_resp("remote playlist entry has local-path - %s" % loadpath)
-        return
-    elif not match_uri(plspath): #localfile playlist except file:
-      if not match_uri(loadpath):
-        loadpath = os.path.join( os.path.dirname(plspath), loadpath)
-    _puts("playlist loadpath=%s", loadpath)
-    # playlist response
-    if match_uri(plspath): plsuri = plspath
-    else:
-      plsuri= "file://" + urllib.pathname2url(plspath)
-    resp("SHOUTCAST", plsuri, entrynum,
-         entry.get("length",-1), entry.get("title",""))
-    # load
-    self.load_command([loadpath])
-
-  def make_duration_watcher(self):
-    _oldvalues = [-1, -1]
-    def _output():
-      if self.has_state(gst.STATE_PLAYING):
-        (dur, pos) = (self.query_duration(None), self.query_position(None))
-        if (dur is not None) and (pos is not None):
-          if dur >= 0:
-            dur = nano2sec(dur)
-          else: dur = -1
-          if pos >= 0:
-            pos = nano2sec(pos)
-          else: pos = -1
-          if (pos != _oldvalues[1]) or (dur != _oldvalues[0]):
-            (_oldvalues[0], _oldvalues[1]) = (dur, pos)
-            resp("T", "%s/%s" % (-1 if pos < 0 else sec2str(pos),
-                                  -1 if dur < 0 else sec2str(dur)))
-      elif self.has_state(gst.STATE_NULL):
-        (_oldvalues[0], _oldvalues[1]) = (-1, -1)
-      return True
-    return _output
-    
-  def get_command(self):
-    "Get command from cmdqueue, and ignore repeated command"
-    def skip_with_addvalue(cmd, next_cmdlist):
-      nextcmd = next_cmdlist[0]
-      if cmd[0] == nextcmd[0]:
-        try:
-          newvalue = str( long(cmd[1]) + long(nextcmd[1]) )
-        except (IndexError, ValueError): return False
-        nextcmd[1] = newvalue # update! nextcmd[1]
-        return True
-      return False
-
-    with self.cmdqueue.lock:
-      cmdlist = self.cmdqueue.cmdlist
-      if _isdebug and cmdlist:  # for debug
-        print "CMDLIST=", self.cmdqueue.cmdlist # for debug
-      while cmdlist:
-        cmd = cmdlist.pop(0)
-        if not cmdlist: return cmd
-        elif cmd[0] in ("pause", "rec", "replay"):
-          if cmd[0] == cmdlist[0][0] :
-            if cmd[0] != "replay":
-              # skip this and next one
-              cmdlist.pop(0)
-          else: return cmd
-        elif cmd[0] == "skip":
-          if skip_with_addvalue(cmd, cmdlist):
-            continue
-          return cmd
-        else: return cmd
-      return None
+  def set_rec_location(self, path):
+    self.fsink.set_property("location", path)
 
-  def dispatch_command(self):
-    try:
-      #cmdline = self.cmdqueue.get()
-      cmdline = self.get_command()
-      if cmdline:
-        _puts("dispatch_command cmdline=%s thread=%s", cmdline, threading.currentThread())
-        command = cmdline[0]
-        args = cmdline[1:]
-        cmdop = self.dispatch_table.get(command)
-        try:
-          if cmdop: cmdop(args)
-          else:
-            err_resp("Illegal command - %s" % command)
-        except Exception , exc:
-          self.requests.clear()
-          tblist = traceback.format_tb(sys.exc_info()[2])
-          if _isdebug:
-            for tbstr in tblist: sys.stdout.write(tbstr)
-            sys.stdout.flush()
-          err_resp("fail to dispatch_command: %s - %s" % (exc, cmdline))
-      return True
-    except BaseException, err: 
-      if not isinstance(err, KeyboardInterrupt):
-        if _isdebug:
-          tblist = traceback.format_tb(sys.exc_info()[2])
-          for tbstr in tblist: sys.stdout.write(tbstr)
-          sys.stdout.flush()
-      self.quit()
-
-  def response_by_state(self, ostate, nstate):
-    _puts("response_by_state req=%s", self.requests)
-    if nstate == gst.STATE_PLAYING:
-      if _PLAYING in self.requests:
-        resp("PLAY")
-        self.requests.discard(_PLAYING)
-      if _LOADING in self.requests:
-        uri = self.player.get_property("uri")
-        resp("LOAD", uri)
-        self.requests.discard(_LOADING)
-    elif nstate == gst.STATE_PAUSED:
-      if _PAUSING in self.requests:
-        resp("PAUSE")
-        self.requests.discard(_PAUSING)
-    elif nstate == gst.STATE_NULL: # Not coming here
-      if _PAUSING in self.requests:
-        resp("PAUSE")
-        self.requests.discard(_PAUSING)
-      if _STOPPING in self.requests:
-        resp("STOP")
-        self.requests.discard(_STOPPING)
+  def replace_sinks(self, conf):
+    recording = self.is_recording()
+    self.sink_conf = conf
+    self.asink_org = new_audiosink(conf, "asink-org")
+    self.recsink = self.new_recsink()
+    self.fsink = self.recsink.get_by_name("fsink")
+    if self.tshift:
+      # playbin2 renders to the time-shift buffer, replace output only
+      self.tshift.replace_sink(conf)
+    else: self.set_recording(recording)
+
+  def set_level(self, interval):
+    self.sink_conf = dict(self.sink_conf, level=interval)
+    sinks = [self.asink_org, self.recsink.get_by_name("asink")]
+    if self.tshift: sinks.append(self.tshift.asink)
+    for sinkbin in sinks: set_level(sinkbin, interval)
+
+  def open_timeshift(self, seconds, rec_end):
+    self.tshift = TimeShift(seconds, rec_end, self.sink_conf)
+    self.player.set_property("audio-sink", self.tshift.capsink)
+    self.tshift.start()
+    return self.tshift
+
+  def close_timeshift(self):
+    (f, self.tshift) = (self.tshift.close(), None)
+    self.set_recording(False)
+    return f
 
   def print_caps(self):
     "for debug"
@@ -762,12 +854,13 @@ class CLIPlayer(object):
         print "CAP width=",w, "depth=",d,"rate=",rate, "channels=", ch
 
   def report_caps(self, sink):
+    if not _events.wants("caps"): return
     for pad in sink.sink_pads():
       caps = pad.get_negotiated_caps()
       if not caps:  continue
       capinfo = caps[0]
       #print "CAP structure_name=", capinfo.get_name(), "keys=", capinfo.keys()
-      resp("CAP", capinfo.get_name(), " ".join(
+      event_resp("caps", "CAP", capinfo.get_name(), " ".join(
           ("%s=%s" % (k, capinfo[k]) for k in capinfo.keys()) ))
 
   def test_image(self, buf): # debug function for capture image
@@ -778,64 +871,60 @@ class CLIPlayer(object):
     with open("/tmp/gaplay-test.img","wb") as f:
       f.write(buf.data)
 
+  def tags(self, message):
+    "(A|V|-, [(key, value)...]) of TAG message"
+    srctype = "-"
+    if message.src:
+      # video-bitrate or audio-bitrate? (fix-me ad hoc!)
+      klass = message.src.get_factory().get_klass().lower()
+      # print "srcname=", message.src.get_name(), " klass=",klass # debug
+      if "audio" in klass: srctype = "A"
+      elif "video" in klass: srctype = "V"
+    tags = message.parse_tag()
+    result = []
+    for k in tags.keys():
+      v = tags[k]
+      if not isinstance(v, (basestring, int, float, long, bool, gst.Date)):
+        # if _isdebug: # image test
+        #  if k == "image" and isinstance(v, gst.Buffer): self.test_image(v)
+        v = type(v)
+      result.append((k, v))
+    return (srctype, result)
+
   def on_message(self, bus, message):
+    listener = self.listener
     try:
-      if threading.currentThread() != mainloop_thread :
+      if threading.currentThread() != self.mainloop_thread :
         err_resp("on_message is not run main thread -%s" % threading.currentThread())
       mtype= message.type
       if mtype== gst.MESSAGE_EOS:
-        uri = self.player.get_property("uri")
-        self.player.set_state(gst.STATE_NULL)
-        resp("STOP")
-        resp("EOS", uri)
+        listener.on_eos()
       elif mtype== gst.MESSAGE_TAG:
-        srctype = "-"
-        if message.src:
-          # video-bitrate or audio-bitrate? (fix-me ad hoc!)
-          klass = message.src.get_factory().get_klass().lower()
-          # print "srcname=", message.src.get_name(), " klass=",klass # debug
-          if "audio" in klass: srctype = "A"
-          elif "video" in klass: srctype = "V"
-        tags = message.parse_tag()
-        for k in tags.keys():
-          v = tags[k]
-          if isinstance(v, (basestring, int, float, long, bool, gst.Date)):
-            resp("TAG", srctype, "%s=%s" % (k, v))
-          else:
-            # if _isdebug: # image test
-            #  if k == "image" and isinstance(v, gst.Buffer): self.test_image(v)
-            resp("TAG", srctype, "%s=%s" % (k, type(v)))
+        listener.on_tags(*self.tags(message))
       elif mtype == gst.MESSAGE_STATE_CHANGED:
         (o_state, n_state, pending) = message.parse_state_changed()
-        (old, new, ps) = ( gst.element_state_get_name(o_state),
-                           gst.element_state_get_name(n_state),
-                           gst.element_state_get_name(pending))
-        # _puts("State changed %s => %s pending:%s",old, new, ps)
         # _puts("audio-sink %s", self.player.get_property("audio-sink"))
-        if not self.asink_org:
-          # Set original audiosink
-          asink = self.player.get_property("audio-sink")
-          if asink and (asink != self.recsink):
-            _puts("Set original asink to %s", asink)
-            self.asink_org = asink
-        elif (o_state == gst.STATE_READY) and (n_state == gst.STATE_PAUSED):
+        if (o_state == gst.STATE_READY) and (n_state == gst.STATE_PAUSED):
           # Report audiosink negotiated capacities
           self.report_caps(self.asink_org)
-
-        if self.requests:
-          self.response_by_state(o_state, n_state)
-
+        if message.src == self.player:
+          listener.on_state_changed(state2str(o_state), state2str(n_state),
+                                    state2str(pending))
+      elif mtype == gst.MESSAGE_ASYNC_DONE:
+        if message.src == self.player: listener.on_async_done()
+      elif mtype == gst.MESSAGE_DURATION:
+        listener.on_duration()
+      elif mtype== gst.MESSAGE_BUFFERING:
+        listener.on_buffering(message.parse_buffering())
+      elif mtype == gst.MESSAGE_ELEMENT:
+        level_resp(message)
       elif mtype== gst.MESSAGE_WARNING:
         err, debug = message.parse_warning()
-        if _isdebug: wrn_resp("%s - %s" % (err, debug))
-        else: wrn_resp(err)
+        listener.on_warning(err, debug)
       elif mtype== gst.MESSAGE_ERROR:
-        self.player.set_state(gst.STATE_NULL)
         err, debug = message.parse_error()
-        if _isdebug: err_resp("%s - %s" % (err, debug))
-        else: err_resp(err)
-        self.stop()
-        resp("STOP")
+        listener.on_error(err, debug, is_network_error(
+            err, self.uri(), _NET_RESOURCE_ERRORS))
       else:
         _puts("On message: Unsupported message type %s", mtype)
         _puts("  src %s", message.src)
@@ -847,157 +936,37 @@ class CLIPlayer(object):
     except Exception , exc:
       err_resp("on_message - %s" % exc)
 
-if sys.version_info[0] >= 2 and sys.version_info[1] >= 6:
-  _urlopen = urllib2.urlopen
-else:
-  # when python 2.5 , ignore timeout argument
-  _urlopen = lambda *args,**kwd: urllib2.urlopen(*args[:2])
-
-# raise urllib2.URLError < IOError
-def get_playlist(path, http_force=False, timeout=30):
-  r'''Read pls or m3u playlist , return following dictionary 
-  {"_type":"m3u|pls", 
-   "_entries":{["file":file-name, "length":duration, "title":title]...},
-   "numberofentries":Number-Of-Entries }'''
-  path = path.strip()
-  filetype = None
-  m = re.match(r'''(http|https|ftp)://''', path, re.I)
-  if m:
-    proto = m.group(1).lower()
-    f = None
-    try:
-      # f = urllib2.urlopen(path, timeout=timeout) 
-      f = _urlopen(path, timeout=timeout) 
-      ctype = f.info().getheader("content-type","").lower().split(";")
-      if ctype[0] == "audio/x-scpls": filetype = "pls"
-      elif ctype[0] == "audio/x-mpegurl": filetype = "m3u"
-      if filetype or http_force or proto == "ftp":
-        return read_playlist(f, filetype, path)
-      else:
-        return None
-    finally:
-      if f: f.close()
-  else:
-    path = os.path.abspath( os.path.expanduser(path) )
-    (_, ext) = os.path.splitext(path)
-    ext = ext.lower()
-    if ext == ".pls": filetype = "pls"
-    elif ext == ".m3u": filetype = "m3u"
-    with open(path, "r") as f:
-      return read_playlist(f, filetype, path)
-
-def read_playlist(f, filetype, path):
-  line = "\n"
-  if not filetype:
-    # read first line
-    while line and line.strip() == "": line = f.readline(8192)
-    if not line: return(dict())
-    if line.strip() == "": return(dict())
-    if line.strip().lower() == "[playlist]":
-      filetype = "pls"
-    else:
-      filetype = "m3u" # ??
-  
-  if filetype == "pls": return read_pls(f)
-  else: return read_m3u(f, line)
-    
-def read_pls(f, unread=None):
-  r'''Read pls, return following dictionary 
-  {"_type": "pls",
-   "_entries": [{"file":file-name, "length":duration, "title":title}...],
-   "numberofentries": Number-Of-Entries, 
-   "version": versin-number-string }'''
-
-  rchop = re.compile( r'[\n\r]+\Z' )
-  ritem = re.compile( r'''(file|title|length)(\d+)''' )
-  plsinfo = dict()
-  entries = dict()
-  def parse(line):
-    # binary check??
-    if (len(line) > 1024) and ("\x00" in line): raise ValueError
-    if line.strip() == "": return
-    datas = rchop.sub("", line).split("=")
-    if len(datas) <= 1: return
-    key=datas[0].lower().strip()
-    m = ritem.match(key)
-    if m:
-      vkey = m.group(1)
-      nkey = int(m.group(2))
-      val = entries.get(nkey, dict())
-      data = "=".join(datas[1:])
-      try:
-        if vkey == "length": 
-          data = long(data)
-        val[vkey] = data
-        entries[nkey] = val
-      except:pass
-    elif key == "numberofentries":
-      try:  plsinfo[key] = int(datas[1])
-      except ValueError:pass
-    else:
-      plsinfo[key] = "=".join(datas[1:])
-  
-  try:
-    if unread: parse(unread)
-    for line in f: parse(line)
-  
-    plsinfo["_entries"] = [entries[k] for k in sorted(entries.keys())]
-    plsinfo["_type"] = "pls"
-    return plsinfo
-
-  except ValueError:
-    _puts("Not pls file - read_m3u")
-    return dict()
-
-def read_m3u(f, unread=None):
-  r'''Read m3u, return following dictionary 
-  {"_type": "m3u",
-   "_entries":[{"file":file-name, "length":duration, "title":title}...],
-   "numberofentries":Number-Of-Entries }'''
-  rchop = re.compile( r'[\n\r]+\Z' )
-  entries = list()
-  extinf = dict()
-  def parse(line):
-    # binary check??
-    if (len(line) > 1024) and ("\x00" in line): raise ValueError
-    if line.strip() == "": return
-    line = rchop.sub("", line)
-    if line[0] == "#":
-      m = re.match("#extinf:", line, re.I)
-      if m:
-        datas = line[m.end():].split(",", 1)
-        try:
-          extinf["length"] = long(datas[0])
-        except:pass
-        if len(datas) > 1: extinf["title"] = datas[1]
-    else:
-      extinf["file"] = line
-      entries.append(dict(extinf))
-      extinf.clear()
-
-  try:
-    if unread: parse(unread)
-    for line in f: parse(line)
-    return {"_type":"m3u", "_entries":entries, "numberofentries":len(entries)}
-  except ValueError:
-    _puts("Not m3u file - read_m3u")
-    return dict()
-
 if __name__ == "__main__":
   signal.signal(signal.SIGTSTP, signal.SIG_IGN) # disable C-Z
   #_puts("main thread=%s", threading.currentThread()) # debug
+  try:
+    (opts, args) = getopt.getopt(sys.argv[1:], "",
+                                 PLAYER_OPTIONS + ["captures"])
+    conf = player_options(opts)
+    captures = ("--captures", "") in opts
+    sink_conf = parse_sink_args(sink_args(opts), SINK_DEFAULT,
+                                gst.element_factory_find)
+  except (getopt.GetoptError, ValueError), exc:
+    err_resp("%s - %s" % (_program, exc))
+    exit(2)
+
+  if conf["job"]: exit(run_postproc_job(_program, args, conf, GST_LAUNCH))
+
   cmdqueue = CommandQueue()
-  player = CLIPlayer(cmdqueue)
+  if captures: player = CaptureDaemon(cmdqueue)
+  else: player = CLIPlayer(cmdqueue, Engine010(sink_conf), conf["normalize"],
+                           conf["prefetch"])
   read_thread = threading.Thread(target=read_command, args=(cmdqueue,))
   read_thread.daemon = True
   read_thread.start()
+  player.configure(conf["retention"], conf["postproc"])
 
   gobject.threads_init()
-  mainloop_thread = threading.currentThread()
-  gobject.idle_add(player.dispatch_command)
-  gobject.timeout_add(500, player.make_duration_watcher())
   # loop = glib.MainLoop()
   loop = gobject.MainLoop()
+  if captures: # mostly idle, poll commands
+    gobject.timeout_add(100, player.dispatch_command)
+  else: player.start(loop)
 
   def killself(*args):
     player.quit()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# GStreamer 1.x engine of gaplay.py (PyGObject, playbin3 or playbin).
+# Runs CLIPlayer of gaplay_common.py, started by `gaplay.py --engine=gst1'.
+# Copyright (c) 2012 Tetsu Takaishi.  All rights reserved.
+#
+# Not supported (yet) compared with gaplay.py:
+#  time-shift, level metering and captures.
+#
+# Benchmark of both engines:
+#   $ python gaplay1.py --benchmark [--rounds=N] FILE1 FILE2
+#
+from __future__ import with_statement
+
+_version="0.8.0"
+_program="gaplay1.py"
+_copyright = "Copyright (c) 2012 Tetsu Takaishi.  All rights reserved."
+_license = "BSD"
+
+import sys, time, os, threading, signal
+import os.path, getopt, subprocess, Queue
+from gaplay_common import _puts, SINK_DEFAULT, CommandQueue, read_command, \
+    resp, err_resp, path2uri, parse_sink_args, sink_args, is_network_error, \
+    Engine, CLIPlayer, PLAYER_OPTIONS, player_options, run_postproc_job
+
+BENCH_TIMEOUT = 10 # sec, wait for each response in benchmark
+BENCH_SEEK = 5 # sec, jump position in benchmark
+GST_LAUNCH = "gst-launch-1.0"
+
+#
+# Benchmark, runs each engine as a subprocess and measures responses
+#
+def bench_reader(proc, lines):
+  for line in iter(proc.stdout.readline, ""): lines.put(line)
+  lines.put(None)
+
+def bench_wait(lines, header, started):
+  "msec until `->HEADER' response, None when timed out or failed"
+  while True:
+    try: line = lines.get(timeout=max(0, started + BENCH_TIMEOUT - time.time()))
+    except Queue.Empty: return None
+    if line is None: return None
+    if line.startswith("->ERROR"):
+      _puts("benchmark %s", line.rstrip())
+      return None
+    if line.startswith("->" + header + " ") or line.rstrip() == "->" + header:
+      return int((time.time() - started) * 1000)
+
+def bench_engine(argv, files):
+  "Returns {measure: msec|None} of one run"
+  result = dict()
+  started = time.time()
+  proc = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+  lines = Queue.Queue()
+  reader = threading.Thread(target=bench_reader, args=(proc, lines))
+  reader.daemon = True
+  reader.start()
+  def request(measure, command, header):
+    started = time.time()
+    proc.stdin.write(command + "\n")
+    proc.stdin.flush()
+    result[measure] = bench_wait(lines, header, started)
+  try:
+    result["startup"] = bench_wait(lines, "READY", started)
+    request("load", "load " + files[0], "LOAD")
+    request("switch", "load " + files[-1], "LOAD")
+    request("seek", "jump %d" % BENCH_SEEK, "SEEK")
+    proc.stdin.write("quit\n")
+    proc.stdin.flush()
+  except IOError: pass # engine died
+  bench_wait(lines, "QUIT", time.time())
+  if proc.poll() is None: proc.kill()
+  return result
+
+def benchmark(files, rounds):
+  basedir = os.path.dirname(os.path.abspath(__file__))
+  for (engine, script) in (("gst0.10", "gaplay.py"), ("gst1", "gaplay1.py")):
+    argv = [sys.executable, os.path.join(basedir, script)]
+    results = dict()
+    for _ in range(rounds):
+      for (measure, msec) in bench_engine(argv, files).items():
+        results.setdefault(measure, []).append(msec)
+    def median(values):
+      values = sorted(v for v in values if v is not None)
+      return ("%dms" % values[len(values) // 2]) if values else "-"
+    resp("BENCH", engine, *["%s=%s" % (measure, median(results.get(measure, [])))
+                            for measure in ("startup", "load", "switch", "seek")])
+
+if __name__ == "__main__":
+  try:
+    (opts, args) = getopt.getopt(sys.argv[1:], "",
+                                 PLAYER_OPTIONS + ["benchmark", "rounds="])
+    if "--benchmark" in [opt for (opt, _) in opts]:
+      rounds = int(dict(opts).get("--rounds", 3))
+      files = [path for path in args if path2uri(path)]
+      if not files: raise ValueError("usage: --benchmark [--rounds=N] FILE...")
+      benchmark(files, rounds)
+      exit()
+    conf = player_options(opts)
+    sink_conf = parse_sink_args(sink_args(opts), SINK_DEFAULT)
+  except (getopt.GetoptError, ValueError), exc:
+    err_resp("%s - %s" % (_program, exc))
+    exit(2)
+  if conf["job"]: exit(run_postproc_job(_program, args, conf, GST_LAUNCH))
+
+# after option parsing, --benchmark and --postproc-job run without gi
+import gi
+gi.require_version("Gst", "1.0")
+from gi.repository import GLib, Gst
+Gst.init(None)
+
+# seek flags for each seek mode
+SEEK_FLAGS = {
+  "normal": Gst.SeekFlags.FLUSH,
+  "scrub": Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT | \
+      Gst.SeekFlags.SNAP_NEAREST,
+  "accurate": Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE,
+}
+
+def new_audiosink(conf, name=None):
+  "Create audio sink by conf (see SINK_DEFAULT)"
+  asink = Gst.ElementFactory.make(conf["element"], name)
+  if asink is None: raise ValueError("no such element - %s" % conf["element"])
+  def configure(elem):
+    props = [pspec.name for pspec in elem.list_properties()]
+    for key in ("device", "buffer-time", "latency-time"):
+      if (conf.get(key) is not None) and (key in props):
+        elem.set_property(key, conf[key])
+  configure(asink)
+  if isinstance(asink, Gst.Bin): # e.g. autoaudiosink creates actual sink later
+    asink.connect("element-added", lambda bin, elem: configure(elem))
+  return asink
+
+_NET_RESOURCE_ERRORS = (Gst.ResourceError.NOT_FOUND,
+                        Gst.ResourceError.OPEN_READ, Gst.ResourceError.READ,
+                        Gst.ResourceError.SEEK)
+
+# GStreamer 1.x engine of CLIPlayer by playbin3 (or playbin), see Engine.
+class Engine1(Engine):
+  name = "gst1"
+  script = os.path.abspath(__file__)
+  gst_launch = GST_LAUNCH
+  decodebin = "decodebin"
+
+  def __init__(self, sink_conf=SINK_DEFAULT):
+    (self.idle_add, self.timeout_add, self.source_remove) = (
+      GLib.idle_add, GLib.timeout_add, GLib.source_remove)
+    self.sink_conf = sink_conf
+    factory = "playbin3" if Gst.ElementFactory.find("playbin3") else "playbin"
+    self.player = Gst.ElementFactory.make(factory, "player")
+    self.player.set_property("video-sink",
+                             Gst.ElementFactory.make("fakesink", "fakevideo"))
+    self.player.set_property("flags", 0x0012) # soft-volume+audio
+    self.asink_org = new_audiosink(sink_conf, "asink-org")
+    self.player.set_property("audio-sink", self.asink_org)
+    self.recsink = self.new_recsink()
+    self.fsink = self.recsink.get_by_name("fsink")
+    bus = self.player.get_bus()
+    bus.add_signal_watch()
+    bus.connect("message", self.on_message)
+
+  def new_recsink(self):
+    "Record branch, tee to audio sink and wav file"
+    recsink = Gst.parse_bin_from_description(
+      "tee name=t ! queue ! audioconvert ! wavenc ! filesink name=fsink"
+      " t. ! queue name=queue-a", False)
+    asink = new_audiosink(self.sink_conf, "asink")
+    recsink.add(asink)
+    recsink.get_by_name("queue-a").link(asink)
+    tee = recsink.get_by_name("t")
+    recsink.add_pad(Gst.GhostPad.new("sink", tee.get_static_pad("sink")))
+    return recsink
+
+  def has_element(self, name):
+    return Gst.ElementFactory.find(name) is not None
+
+  def uri(self):
+    return self.player.get_property("uri")
+
+  def set_uri(self, uri):
+    self.player.set_property("uri", uri)
+
+  def get_state(self, timeout=500):
+    (ret, state, pending) = self.player.get_state(timeout * Gst.MSECOND)
+    return (Gst.Element.state_change_return_get_name(ret),
+            Gst.Element.state_get_name(state),
+            Gst.Element.state_get_name(pending))
+
+  def set_state(self, state):
+    ret = self.player.set_state(getattr(Gst.State, state))
+    return Gst.Element.state_change_return_get_name(ret)
+
+  def play(self):
+    # keep volume across NULL -> PLAYING
+    vol = self.player.get_property("volume")
+    self.player.set_state(Gst.State.PLAYING)
+    self.player.set_property("volume", vol)
+
+  def duration(self, fallback=-1):
+    (ok, dur) = self.player.query_duration(Gst.Format.TIME)
+    return dur if ok else fallback
+
+  def position(self, fallback=-1):
+    (ok, pos) = self.player.query_position(Gst.Format.TIME)
+    return pos if ok else fallback
+
+  def seek(self, nsec, mode="normal"):
+    return self.player.seek_simple(Gst.Format.TIME, SEEK_FLAGS[mode], nsec)
+
+  def volume(self, vol=None):
+    if vol is not None: self.player.set_property("volume", vol)
+    return self.player.get_property("volume")
+
+  def latency(self):
+    query = Gst.Query.new_latency()
+    if self.player.query(query): return query.parse_latency()[1]
+    return None
+
+  def is_recording(self):
+    return self.player.get_property("audio-sink") == self.recsink
+
+  def set_recording(self, on):
+    self.player.set_property("audio-sink",
+                             self.recsink if on else self.asink_org)
+
+  def rec_location(self):
+    return self.fsink.get_property("location")
+
+  def set_rec_location(self, path):
+    self.fsink.set_property("location", path)
+
+  def replace_sinks(self, conf):
+    recording = self.is_recording()
+    self.sink_conf = conf
+    self.asink_org = new_audiosink(conf, "asink-org")
+    self.recsink = self.new_recsink()
+    self.fsink = self.recsink.get_by_name("fsink")
+    self.set_recording(recording)
+
+  def tags(self, message):
+    "(A|V|-, [(key, value)...]) of TAG message"
+    srctype = "-"
+    factory = message.src and message.src.get_factory()
+    if factory:
+      klass = (factory.get_metadata("klass") or "").lower()
+      if "audio" in klass: srctype = "A"
+      elif "video" in klass: srctype = "V"
+    taglist = message.parse_tag()
+    result = []
+    for i in range(taglist.n_tags()):
+      key = taglist.nth_tag_name(i)
+      value = taglist.get_value_index(key, 0)
+      if isinstance(value, Gst.DateTime): value = value.to_iso8601_string()
+      elif not isinstance(value, (basestring, int, float, long, bool)):
+        value = type(value)
+      result.append((key, value))
+    return (srctype, result)
+
+  def on_message(self, bus, message):
+    listener = self.listener
+    try:
+      mtype = message.type
+      if mtype == Gst.MessageType.EOS:
+        listener.on_eos()
+      elif mtype == Gst.MessageType.TAG:
+        listener.on_tags(*self.tags(message))
+      elif mtype == Gst.MessageType.STATE_CHANGED:
+        if message.src != self.player: return
+        listener.on_state_changed(*[Gst.Element.state_get_name(state) for state
+                                    in message.parse_state_changed()])
+      elif mtype == Gst.MessageType.ASYNC_DONE:
+        if message.src == self.player: listener.on_async_done()
+      elif mtype == Gst.MessageType.DURATION_CHANGED:
+        listener.on_duration()
+      elif mtype == Gst.MessageType.BUFFERING:
+        listener.on_buffering(message.parse_buffering())
+      elif mtype == Gst.MessageType.WARNING:
+        (err, debug) = message.parse_warning()
+        listener.on_warning(err.message, debug)
+      elif mtype == Gst.MessageType.ERROR:
+        (err, debug) = message.parse_error()
+        listener.on_error(err.message, debug, is_network_error(
+            err, self.uri(), _NET_RESOURCE_ERRORS))
+    except Exception, exc:
+      err_resp("on_message - %s" % exc)
+
+if __name__ == "__main__":
+  signal.signal(signal.SIGTSTP, signal.SIG_IGN) # disable C-Z
+  cmdqueue = CommandQueue()
+  try:
+    player = CLIPlayer(cmdqueue, Engine1(sink_conf), conf["normalize"],
+                       conf["prefetch"])
+  except ValueError, exc:
+    err_resp("%s - %s" % (_program, exc))
+    exit(2)
+  read_thread = threading.Thread(target=read_command, args=(cmdqueue,))
+  read_thread.daemon = True
+  read_thread.start()
+  player.configure(conf["retention"], conf["postproc"])
+
+  loop = GLib.MainLoop()
+  player.start(loop)
+
+  def killself(*args):
+    player.quit()
+    resp("QUIT")
+    exit()
+  signal.signal(signal.SIGHUP, killself) # kill -HUP
+
+  resp("READY", _program, "version:%s" % _version, _copyright)
+  try:
+    loop.run()
+  except KeyboardInterrupt:
+    player.quit()
+    err_resp("keyboard interrupt")
+  resp("QUIT")
+  exit()
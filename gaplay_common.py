@@ -0,0 +1,2479 @@
+# -*- coding: utf-8 -*-
+#
+# Engine independent (GStreamer-free) part of gaplay.py and gaplay1.py:
+# command/response protocol, state files, post-processing and CLIPlayer,
+# which plays through an Engine of either GStreamer version.
+# Copyright (c) 2012 Tetsu Takaishi.  All rights reserved.
+#
+from __future__ import with_statement # for python2.5
+
+import sys, time, re, os, threading, datetime, urllib, urllib2, errno
+import glob, random, wave, audioop, subprocess, fcntl, Queue, traceback
+
+LOAD_PLAYLIST_TIMEOUT = 30
+RECONNECT_MAX_RETRY = 10
+RECONNECT_BASE_DELAY = 1.0  # sec
+RECONNECT_MAX_DELAY = 60.0  # sec
+RECONNECT_STABLE = 30       # sec, playing this long resets backoff
+STALL_TIMEOUT = 15          # sec, position has not advanced while playing
+TIMESHIFT_REC_PREROLL = 30  # sec, `rec' of time-shifted stream starts back
+RETENTION_MAX_AGE = 0        # days of recordings to keep, 0: unlimited
+RETENTION_MAX_BYTES = 0      # total bytes of recordings, 0: unlimited
+RETENTION_INTERVAL = 600     # sec, between sweeps
+RETENTION_GRACE = 60         # sec, never remove files modified recently
+POSTPROC_LOCK = "~/.gaplay/postproc.lock" # jobs run one by one
+POSTPROC_NICE = 19
+POSTPROC_SILENCE = 0.005     # peak (ratio to full scale) regarded as silence
+POSTPROC_ENCODERS = {"flac":(".flac", ["flacenc"]),
+                     "ogg":(".ogg", ["vorbisenc", "!", "oggmux"])}
+POSTPROC_TAGS = ("title", "artist", "album", "genre", "organization")
+BOOKMARK_FILE = "~/.gaplay/bookmarks"
+BOOKMARK_MIN_DURATION = 600  # sec, remember position of longer tracks only
+BOOKMARK_END_MARGIN = 30     # sec, regarded as finished near the end
+BOOKMARK_FLUSH_INTERVAL = 30 # sec
+BOOKMARK_MAX_ENTRIES = 5000
+LEVEL_INTERVAL = 100 # msec, default interval of `level' metering
+LOUDNESS_FILE = "~/.gaplay/loudness"
+LOUDNESS_NICE = 19
+LOUDNESS_MAX_GAIN = 12.0     # dB, limit of amplification by normalization
+LOUDNESS_MAX_ENTRIES = 20000
+PREFETCH_FILE = "~/.gaplay/prefetch"
+PREFETCH_BUDGET = 64         # MB, read ahead of upcoming tracks in total
+PREFETCH_TRACKS = 2          # upcoming tracks kept warm
+PREFETCH_RATE = 16           # MB/sec, not to saturate slow storage
+PREFETCH_CHUNK = 256 * 1024
+PREFETCH_MAX_ENTRIES = 100
+PREFETCH_FRESH = 1800        # sec, warmed pages are likely evicted later
+POSIX_FADV_WILLNEED = 3      # linux
+RESOLVE_FILE = "~/.gaplay/resolve"
+RESOLVE_TTL = 3600           # sec, lifetime of cached redirect target
+RESOLVE_TIMEOUT = 10         # sec
+RESOLVE_MAX_ENTRIES = 500
+SEEK_MIN_INTERVAL = 100     # msec, between flushing seeks
+SEEK_INFLIGHT_TIMEOUT = 1000 # msec, give up waiting for ASYNC_DONE
+RECFILE_TEMPL = "~/.gaplay/rec%Y-%m-%d.wav"
+SINK_KEYS = ("element", "device", "buffer-time", "latency-time")
+SINK_DEFAULT = {"element":"autoaudiosink", "device":None,
+                "buffer-time":None, "latency-time":None}
+# buffer-time/latency-time (usec) of audio sink, None: sink default
+SINK_PROFILES = {"default":{"buffer-time":None, "latency-time":None},
+                 "low-latency":{"buffer-time":40000, "latency-time":10000},
+                 "low-power":{"buffer-time":1000000, "latency-time":100000}}
+
+_isdebug = False
+#_isdebug = True
+
+def _puts(fmt, *args):
+  if _isdebug:
+    msg = fmt % args
+    sys.stdout.write(msg + "\n")
+    # log(msg)
+
+class CommandQueue(object) :
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.cmdlist = []
+  
+  def add(self, command):
+    with self.lock:
+      # time.sleep(1) # for debug
+      self.cmdlist.append(command)
+
+  def get(self, fallback=None):
+    with self.lock:
+      try:
+        cmd = self.cmdlist.pop(0)
+      except IndexError:
+        cmd = fallback
+    return cmd
+
+def read_command(cmdqueue):
+  time.sleep(0.5)
+  try:
+    while True:
+      #time.sleep(0.2)
+      line = sys.stdin.readline()
+      if not line: cmdline = ["quit"]
+      else : cmdline = line.strip().split(None, 1)
+      if len(cmdline) > 0:
+        _puts("read_command cmdline=%s thread=%s", cmdline, threading.currentThread())
+        cmdqueue.add(cmdline)
+        if cmdline[0] == "quit": break
+  except IOError, exc:
+    _puts("read_command IOError - %s", exc)
+    cmdqueue.add(["error", str(exc)])
+    cmdqueue.add(["quit"])
+
+def sec2str(sec):
+  (h, m) = divmod(sec, 3600)
+  (m, s) = divmod(m, 60)
+  if h: return "%02d:%02d:%02d" % (h, m, s)
+  return "%02d:%02d" % (m, s)
+
+def mm2nano(msec):
+  return msec * 1000000
+
+# Return value is rounded off to the decimal place
+def nano2sec(nano, isround=True):
+  return (nano + (500000000 if isround else 0) ) // 1000000000
+
+def to_s(s):
+  if isinstance(s,str): return s
+  elif isinstance(s, unicode): return s.encode("utf-8", "replace")
+  elif s is None: return "none"
+  return str(s)
+
+def resp(title, *msgs):
+  sys.stdout.write("->" + title)
+  if msgs:
+    sys.stdout.write(" " + " ".join( (to_s(s) for s in msgs) ))
+  sys.stdout.write("\n")
+  sys.stdout.flush() # pipe of benchmark is not line buffered
+
+# Event classes of responses, which can be (un)subscribed by client
+EVENT_CLASSES = ("time", "tags", "caps", "buffering", "rec", "state",
+                 "level", "loudness")
+# continuous updates, which may be rate limited.
+# others are discrete (e.g. EOS after STOP) and never dropped.
+EVENT_RATED = ("time", "tags", "buffering", "level")
+
+# example
+#  f = EventFilter()
+#  f.subscribe("tags", 2.0) # at most once per 2 seconds for each tag key
+#  f.subscribe("state", 1.0) #=> ValueError
+#  f.unsubscribe("time")
+#  f.allow("time") #=> False
+class EventFilter(object):
+  def __init__(self):
+    # subscribed class -> min interval (sec)
+    self.intervals = dict((evclass, 0.0) for evclass in EVENT_CLASSES)
+    self.last = dict() # (class, key) -> last emitted time
+
+  def wants(self, evclass):
+    return evclass in self.intervals
+
+  def allow(self, evclass, key=None):
+    "wants evclass and not rate limited, mark it as emitted"
+    interval = self.intervals.get(evclass)
+    if interval is None: return False
+    if interval > 0 and evclass in EVENT_RATED:
+      now = time.time()
+      if now - self.last.get((evclass, key), 0) < interval: return False
+      self.last[(evclass, key)] = now
+    return True
+
+  def subscribe(self, evclass, interval=0.0):
+    if evclass not in EVENT_CLASSES:
+      raise ValueError("unknown event class - %s" % evclass)
+    if interval and evclass not in EVENT_RATED:
+      raise ValueError("%s can't be rate limited" % evclass)
+    self.intervals[evclass] = interval
+
+  def unsubscribe(self, evclass):
+    if evclass not in EVENT_CLASSES:
+      raise ValueError("unknown event class - %s" % evclass)
+    self.intervals.pop(evclass, None)
+
+  def status(self):
+    return ["%s:%g" % (evclass, self.intervals[evclass]) if self.intervals[evclass]
+            else evclass for evclass in EVENT_CLASSES if evclass in self.intervals]
+
+_events = EventFilter()
+
+def event_resp(evclass, title, *msgs):
+  "resp if the client subscribes evclass"
+  if _events.allow(evclass): resp(title, *msgs)
+
+def err_resp(*msgs): resp("ERROR", *msgs)
+def wrn_resp(*msgs): resp("WARNING", *msgs)
+
+def match_uri(path, _rx=re.compile(r'(\w+)://')):
+  return _rx.match(path)
+
+def match_uri2(path, _rx=re.compile(r'''(http|https|ftp)://''', re.I)):
+  "is match http or https or ftp"
+  return _rx.match(path)
+
+def match_http(path, _rx=re.compile(r'''https?://''', re.I)):
+  return _rx.match(path)
+
+def path2uri(path):
+  "Returns uri of path or URL, None if no such local file"
+  if match_uri(path): return path
+  abspath = os.path.abspath( os.path.expanduser(path) )
+  if not os.path.isfile(abspath): return None
+  return "file://" + urllib.pathname2url(abspath)
+
+def uri2path(uri):
+  "Returns local file path of file:// uri or path, None if remote"
+  if uri.lower().startswith("file://"): return urllib.url2pathname(uri[7:])
+  if match_uri(uri): return None
+  return os.path.abspath( os.path.expanduser(uri) )
+
+def is_localpath(path):
+  m = match_uri(path)
+  if m:
+    return m.group(1).lower() in ("file", "dvd", "cdda")
+  return True
+
+# example
+#  t = FileTempl("~/.gaplay/rec%Y-%m-%d.wav")
+#  fname = t.nextfile() ; fname #=> '/Users/tetsu/.gaplay/rec2012-08-28.wav'
+#  fname = t.nextfile() ; fname #=> '/Users/tetsu/.gaplay/rec2012-08-28-1.wav'
+# nextfile creates the returned file (empty) with O_EXCL, so that
+# concurrent recorders never get the same name.
+class FileTempl(object):
+  _counters = dict() # next suffix number per file name, shared by instances
+  _lock = threading.Lock()
+
+  def __init__(self, templ, date_convert=True):
+    self.templ = os.path.abspath( os.path.expanduser(templ) )
+    self.date_convert = date_convert
+
+  # date fields as digits, so that `foo-%Y' does not match `foo-bar-2012'
+  _GLOB_FIELDS = {"Y":"[0-9]" * 4, "m":"[0-9]" * 2, "d":"[0-9]" * 2,
+                  "H":"[0-9]" * 2, "M":"[0-9]" * 2, "S":"[0-9]" * 2}
+
+  def glob(self, ext=None):
+    "glob pattern matching every file of this template (with ext)"
+    templ = self.templ
+    if self.date_convert:
+      templ = re.sub(r'%(.)', lambda m: self._GLOB_FIELDS.get(m.group(1), "*"),
+                     templ)
+    (base, text) = os.path.splitext(templ)
+    return base + "*" + (text if ext is None else ext)
+  #
+  def nextfile(self, create_dir=True):
+    # Replace with strftime
+    if self.date_convert:
+      fname = datetime.date.today().strftime(self.templ)
+    else: fname = self.templ
+    # Create dirs
+    dirpath = os.path.dirname(fname)
+    if not os.path.exists(dirpath):
+      if create_dir: os.makedirs(dirpath)
+    elif not os.path.isdir(dirpath):
+      raise IOError("Fail to create a directory `%s'" % dirpath)
+
+    (base, ext) = os.path.splitext(fname)
+    def numbered(n):
+      if n == 0: return fname
+      return "".join((base, ("-%d" % n), ext))
+    with FileTempl._lock:
+      n = FileTempl._counters.get(fname)
+      if n is None: n = self.probe(numbered)
+      for n in xrange(n, sys.maxint):
+        name = numbered(n)
+        _puts("FileTempl#nextfile name=%s",name)
+        try:
+          os.close(os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666))
+        except OSError, exc:
+          if exc.errno == errno.EEXIST: continue
+          raise IOError("Fail to create recording file - %s" % exc)
+        FileTempl._counters[fname] = n + 1
+        return name
+    raise IOError("Fail to create recording file")
+
+  def probe(self, numbered):
+    "Find first unused number by exponential and binary search"
+    if not os.path.exists(numbered(0)): return 0
+    (lo, hi) = (0, 1) # numbered(lo) exists
+    while os.path.exists(numbered(hi)): (lo, hi) = (hi, hi * 2)
+    while hi - lo > 1:
+      mid = (lo + hi) // 2
+      if os.path.exists(numbered(mid)): lo = mid
+      else: hi = mid
+    return hi
+
+def parse_sink_args(argv, conf, exists=None):
+  """Returns new sink conf updated by argv, raise ValueError if illegal.
+exists(element-name) checks the element by the engine."""
+  (conf, positional) = (dict(conf), ["element", "device"])
+  for arg in argv:
+    if arg in SINK_PROFILES:
+      conf.update(SINK_PROFILES[arg])
+      continue
+    if "=" in arg: (key, value) = arg.split("=", 1)
+    elif positional: (key, value) = (positional[0], arg)
+    else: raise ValueError("illegal sink argument - %s" % arg)
+    if key not in SINK_KEYS: raise ValueError("unknown sink key - %s" % key)
+    if key in positional: positional.remove(key)
+    if key in ("buffer-time", "latency-time"):
+      value = int(value) if value not in ("", "default") else None
+    elif value in ("", "default"):
+      value = SINK_DEFAULT[key]
+    conf[key] = value
+  if exists and not exists(conf["element"]):
+    raise ValueError("no such element - %s" % conf["element"])
+  return conf
+
+def sink_args(opts):
+  "argv of parse_sink_args by --sink* options of getopt"
+  args = []
+  for (opt, value) in opts:
+    if opt == "--sink": args.append("element=" + value)
+    elif opt == "--sink-device": args.append("device=" + value)
+    elif opt == "--sink-profile": args.append(value)
+    elif opt in ("--buffer-time", "--latency-time"):
+      args.append("%s=%s" % (opt[2:], value))
+  return args
+
+# example
+#  t = SeekThrottle(do_seek, gobject.timeout_add, gobject.source_remove)
+#  t.request(nsec, "scrub") # issued at once
+#  t.request(nsec2, "scrub") # kept until ASYNC_DONE of the first
+#  t.done() # on ASYNC_DONE, nsec2 is issued (or timed) => True
+# Flushing seeks run at most every SEEK_MIN_INTERVAL msec, and only the
+# latest request waits for the seek in flight.
+class SeekThrottle(object):
+  def __init__(self, do_seek, timeout_add, source_remove):
+    self.do_seek = do_seek # do_seek(nanosec, mode) => success
+    (self.timeout_add, self.source_remove) = (timeout_add, source_remove)
+    self.req = None # (nanosec, mode) waiting for in-flight seek
+    self.inflight = None # nanosec of issued seek until ASYNC_DONE
+    self.time = 0 # time of last issued seek
+    self.timer = None
+
+  def target(self):
+    "Position of latest request, None without seeking"
+    if self.req: return self.req[0]
+    return self.inflight
+
+  def request(self, nsec, mode):
+    "Seek to nsec, only the latest request runs while a seek is in flight"
+    self.req = (nsec, mode)
+    self.run()
+
+  def run(self):
+    if self.req is None: return False
+    elapsed = (time.time() - self.time) * 1000
+    if self.inflight is not None:
+      delay = SEEK_INFLIGHT_TIMEOUT - elapsed # wait ASYNC_DONE, or give up
+    else: delay = SEEK_MIN_INTERVAL - elapsed
+    if delay > 0:
+      if self.timer is None:
+        self.timer = self.timeout_add(int(delay) + 1, self.on_timer)
+      return False
+    ((nsec, mode), self.req) = (self.req, None)
+    if self.do_seek(nsec, mode):
+      (self.inflight, self.time) = (nsec, time.time())
+    else:
+      self.inflight = None
+      err_resp("fail to seek")
+    return False
+
+  def on_timer(self):
+    self.timer = None
+    self.run()
+    return False
+
+  def cancel(self):
+    (self.req, self.inflight) = (None, None)
+    if self.timer is not None:
+      self.source_remove(self.timer)
+      self.timer = None
+
+  def done(self):
+    "Called on ASYNC_DONE, returns True if a newer request is pending"
+    self.inflight = None
+    if self.timer is not None: # armed for the in-flight timeout
+      self.source_remove(self.timer)
+      self.timer = None
+    if self.req is None: return False
+    self.run()
+    return True
+
+# subscribe/unsubscribe commands of the players
+class EventCommands(object):
+  def subscribe_command(self, args=[]):
+    "subscribe [CLASS[:MIN-INTERVAL-SEC]|all]..."
+    try:
+      for arg in (args and args[0].split()):
+        (name, _, interval) = arg.partition(":")
+        interval = max(0.0, float(interval or 0))
+        if name == "all": # interval applies to continuous classes only
+          for evclass in EVENT_CLASSES:
+            _events.subscribe(evclass,
+                              interval if evclass in EVENT_RATED else 0.0)
+        else: _events.subscribe(name, interval)
+    except ValueError, exc:
+      err_resp("%s (usage: subscribe [CLASS[:SEC]|all]...)" % exc)
+      return
+    resp("EVENTS", *_events.status())
+
+  def unsubscribe_command(self, args=[]):
+    "unsubscribe [CLASS|all]..."
+    try:
+      for arg in (args and args[0].split()):
+        for evclass in (EVENT_CLASSES if arg == "all" else [arg]):
+          _events.unsubscribe(evclass)
+    except ValueError, exc:
+      err_resp("%s (usage: unsubscribe [CLASS|all]...)" % exc)
+      return
+    resp("EVENTS", *_events.status())
+
+# Remove old recordings by max-age and max-bytes policy in background.
+# `busy' is a callable returning files being recorded,
+# `idle_add' is the one of the main loop.
+class RecordSweeper(object):
+  def __init__(self, busy, idle_add):
+    self.lock = threading.Lock()
+    self.patterns = set()
+    (self.max_age, self.max_bytes) = (RETENTION_MAX_AGE, RETENTION_MAX_BYTES)
+    (self.busy, self.idle_add) = (busy, idle_add)
+    self.wakeup = threading.Event()
+
+  def add(self, templ):
+    # including post-processed files
+    pattern = templ.glob(".*")
+    with self.lock:
+      if pattern in self.patterns: return
+      self.patterns.add(pattern)
+    self.wakeup.set() # sweep files left by former runs
+
+  def set_policy(self, max_age, max_bytes):
+    with self.lock: (self.max_age, self.max_bytes) = (max_age, max_bytes)
+    self.wakeup.set()
+
+  def start(self):
+    thread = threading.Thread(target=self.run)
+    thread.daemon = True
+    thread.start()
+
+  def run(self):
+    while True: # sweep at startup, then every RETENTION_INTERVAL
+      self.wakeup.clear()
+      try:
+        (count, nbytes) = self.sweep()
+        if count:
+          self.idle_add(resp, "RETENTION", "removed", count,
+                        "%dKB" % (nbytes // 1024))
+      except Exception, exc:
+        _puts("RecordSweeper#sweep %s", exc)
+      self.wakeup.wait(RETENTION_INTERVAL)
+
+  def sweep(self):
+    "Returns (number-of-removed-files, removed-bytes)"
+    with self.lock:
+      (max_age, max_bytes) = (self.max_age, self.max_bytes)
+      patterns = list(self.patterns)
+    if not (max_age or max_bytes): return (0, 0)
+    files = []
+    for pattern in patterns:
+      for path in glob.glob(pattern):
+        try: st = os.stat(path)
+        except OSError: continue
+        files.append((st.st_mtime, st.st_size, path))
+    files.sort() # oldest first
+    total = sum(size for (_, size, _) in files)
+    (now, busy) = (time.time(), set(self.busy()))
+    (count, nbytes) = (0, 0)
+    for (mtime, size, path) in files:
+      if (path in busy) or (now - mtime < RETENTION_GRACE): continue
+      if not ((max_age and now - mtime > max_age * 86400) or
+              (max_bytes and total > max_bytes)):
+        continue
+      try: os.remove(path)
+      except OSError, exc:
+        _puts("RecordSweeper#sweep %s", exc)
+        continue
+      total -= size
+      (count, nbytes) = (count + 1, nbytes + size)
+    return (count, nbytes)
+
+# example
+#  b = Backoff()
+#  b.next_delay() #=> 0.5..1.0
+#  b.next_delay() #=> 1.0..2.0
+#  b.reset()
+class Backoff(object):
+  "Exponential backoff with jitter"
+  def __init__(self, base=RECONNECT_BASE_DELAY, maxdelay=RECONNECT_MAX_DELAY,
+               maxretry=RECONNECT_MAX_RETRY):
+    (self.base, self.maxdelay, self.maxretry) = (base, maxdelay, maxretry)
+    self.attempts = 0
+
+  def reset(self):
+    self.attempts = 0
+
+  def exhausted(self):
+    return self.attempts >= self.maxretry
+
+  def next_delay(self):
+    delay = min(self.maxdelay, self.base * (2 ** self.attempts))
+    self.attempts += 1
+    # spread retries over [delay/2, delay]
+    return delay * (0.5 + random.random() / 2)
+
+def wav_sampwidth(path):
+  "Bytes per sample of wav file"
+  reader = wave.open(path, "rb")
+  try: return reader.getsampwidth()
+  finally: reader.close()
+
+def trim_silence(src, dst, threshold=POSTPROC_SILENCE, progress=None):
+  "Copy wav file src to dst without leading and trailing silence"
+  reader = wave.open(src, "rb")
+  try:
+    (nch, width, rate) = (reader.getnchannels(), reader.getsampwidth(),
+                          reader.getframerate())
+    limit = int(threshold * (1 << (8 * width - 1)))
+    (chunk, fsize) = (max(1, rate // 10), max(1, os.path.getsize(src)))
+    # Don't trust nframes, the header of unfinished wav may be a dummy
+    (first, last, n, reported) = (None, None, 0, 0)
+    while True:
+      data = reader.readframes(chunk)
+      if not data: break
+      if audioop.max(data, width) > limit:
+        if first is None: first = n
+        last = n
+      n += 1
+      pct = min(100, n * chunk * nch * width * 100 // fsize)
+      if progress and pct >= reported + 10:
+        reported = pct - pct % 10
+        progress(reported)
+    reader.rewind()
+    writer = wave.open(dst, "wb")
+    try:
+      writer.setparams((nch, width, rate, 0, "NONE", "not compressed"))
+      if first is not None:
+        for n in xrange(last + 1):
+          data = reader.readframes(chunk)
+          if n >= first: writer.writeframes(data)
+    finally: writer.close()
+  finally: reader.close()
+
+def transcode(src, dst, encoder, tags, gst_launch):
+  "Encode wav file by nice'd gst-launch"
+  cmd = ["nice", "-n", str(POSTPROC_NICE), gst_launch, "-q",
+         "filesrc", 'location="%s"' % src, "!", "wavparse", "!",
+         "audioconvert", "!"]
+  if tags:
+    cmd.extend(["taginject", 'tags="%s"' % ",".join(
+          '%s=\\"%s\\"' % (k, re.sub(r'["\\]', "", to_s(v)))
+          for (k, v) in sorted(tags.items())), "!"])
+  cmd.extend(encoder + ["!", "filesink", 'location="%s"' % dst])
+  proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT)
+  output = proc.communicate()[0]
+  if proc.returncode != 0:
+    raise IOError("%s - %s" % (gst_launch, " ".join(output.split())))
+
+def parse_postproc_mode(words):
+  "[off|wav|flac|ogg [trim] [remove]] -> (fmt, trim, remove)"
+  if (not words) or words[0] == "off": return (None, False, False)
+  if (words[0] not in POSTPROC_ENCODERS and words[0] != "wav") or \
+        [opt for opt in words[1:] if opt not in ("trim", "remove")]:
+    raise ValueError("illegal postproc mode - %s" % " ".join(words))
+  return (words[0], "trim" in words[1:], "remove" in words[1:])
+
+def postproc_job(path, tags, gst_launch, fmt, trim, remove):
+  "Body of `gaplay.py --postproc-job', reports progress to stdout"
+  def output(*msgs):
+    try:
+      resp(*msgs)
+      sys.stdout.flush()
+    except IOError: # parent has quit, finish the job silently
+      sys.stdout = open(os.devnull, "w")
+  report = lambda *msgs: output("POSTPROC", *msgs)
+  lockpath = os.path.expanduser(POSTPROC_LOCK)
+  if not os.path.isdir(os.path.dirname(lockpath)):
+    os.makedirs(os.path.dirname(lockpath))
+  lock = open(lockpath, "a")
+  try:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    report("start", path)
+    (src, temps, out) = (path, [], None)
+    try:
+      width = trim and wav_sampwidth(path)
+      if trim and width not in (1, 2, 4): # python2 audioop, not 24-bit
+        output("WARNING", "not trimmed, %d-bit samples - %s" %
+               (8 * width, path))
+        trim = False
+      if trim:
+        src = "%s.trim.wav" % os.path.splitext(path)[0]
+        temps.append(src)
+        trim_silence(path, src, progress=lambda pct:
+                       report("trim", path, "%d%%" % pct))
+      if fmt == "wav":
+        if trim: os.rename(src, path)
+        out = path
+      else:
+        (ext, encoder) = POSTPROC_ENCODERS[fmt]
+        out = FileTempl(os.path.splitext(path)[0] + ext, False).nextfile()
+        report("encode", path, out)
+        transcode(src, out, encoder, tags, gst_launch)
+        if remove: temps.append(path)
+    except Exception, exc:
+      if out and out != path: temps.append(out)
+      report("fail", path, exc)
+      return 1
+    finally:
+      for f in temps:
+        try: os.remove(f)
+        except OSError: pass
+    report("done", path, out)
+    return 0
+  finally: lock.close()
+
+# Post-process finished recordings (trim silence, transcode) by
+# detached nice'd `SCRIPT --postproc-job' processes, which outlive
+# the player process restarted on every track change.
+class PostProcessor(object):
+  def __init__(self, script, idle_add, fmt=None, trim=False, remove=False):
+    (self.script, self.idle_add) = (script, idle_add)
+    self.fmt = fmt # None(disable)|wav|flac|ogg
+    (self.trim, self.remove) = (trim, remove)
+    self.running = set() # paths of jobs started by this process
+
+  def submit(self, path, tags=None):
+    "Start a job for a finished recording if enabled"
+    if not self.fmt: return False
+    mode = ",".join([self.fmt] + ["trim"] * self.trim + ["remove"] * self.remove)
+    cmd = ["nice", "-n", str(POSTPROC_NICE), sys.executable,
+           self.script, "--postproc-job=" + mode]
+    cmd.extend("--tag=%s=%s" % (k, to_s(v)) for (k, v) in
+               sorted((tags or {}).items()))
+    cmd.append(path)
+    devnull = open(os.devnull, "r")
+    try:
+      # own session, not to be killed with the player
+      proc = subprocess.Popen(cmd, stdin=devnull, stdout=subprocess.PIPE,
+                              close_fds=True, preexec_fn=os.setsid)
+    finally: devnull.close()
+    self.running.add(path)
+    thread = threading.Thread(target=self.relay, args=(proc, path))
+    thread.daemon = True
+    thread.start()
+    event_resp("rec", "POSTPROC", "queued", path, len(self.running))
+    return True
+
+  def relay(self, proc, path):
+    "Pass progress of the job to the client, in own thread"
+    for line in iter(proc.stdout.readline, ""):
+      if line.startswith("->POSTPROC "):
+        self.idle_add(event_resp, "rec", "POSTPROC",
+                      line[len("->POSTPROC "):].rstrip("\n"))
+      elif line.startswith("->WARNING "):
+        self.idle_add(wrn_resp, line[len("->WARNING "):].rstrip("\n"))
+    proc.wait()
+    self.idle_add(self.running.discard, path)
+
+def analyze_loudness(path, gst_launch, decodebin):
+  "Returns (ReplayGain track gain dB, peak) of path by nice'd gst-launch"
+  cmd = ["nice", "-n", str(LOUDNESS_NICE), gst_launch, "-m",
+         "filesrc", 'location="%s"' % path, "!", decodebin, "!",
+         "audioconvert", "!", "audioresample", "!", "rganalysis", "!",
+         "fakesink"]
+  proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT)
+  output = proc.communicate()[0]
+  if proc.returncode != 0:
+    raise IOError("%s - %s" % (gst_launch, " ".join(output.split()[-20:])))
+  number = r'\(double\)\s*([-+.0-9eE]+)'
+  gain = re.search(r'replaygain-track-gain=' + number, output)
+  peak = re.search(r'replaygain-track-peak=' + number, output)
+  if not gain: raise IOError("no replaygain result - %s" % path)
+  return (float(gain.group(1)), float(peak.group(1)) if peak else 1.0)
+
+def gain_factor(gain, peak):
+  "Volume factor of ReplayGain (dB), limited not to clip the peak"
+  factor = 10 ** (min(gain, LOUDNESS_MAX_GAIN) / 20.0)
+  if peak > 0: factor = min(factor, 1.0 / peak)
+  return factor
+
+# Lines of TAB separated fields under ~/.gaplay, replaced atomically on save.
+class TabFile(object):
+  def __init__(self, path, name):
+    self.path = os.path.abspath( os.path.expanduser(path) )
+    self.name = name # for messages
+
+  def load(self):
+    "Lines without newline, [] if not saved yet"
+    try:
+      with open(self.path, "r") as f:
+        return [line.rstrip("\r\n") for line in f]
+    except IOError, exc:
+      if exc.errno != errno.ENOENT:
+        wrn_resp("fail to load %s - %s" % (self.name, exc))
+      return []
+
+  def rows(self, nfields):
+    "[[field...]...] of lines having nfields fields, last one may contain TAB"
+    return [fields for fields in (line.split("\t", nfields - 1)
+                                  for line in self.load())
+            if len(fields) == nfields]
+
+  def save(self, lines):
+    "Replace the file by lines, returns False on error"
+    try:
+      dirpath = os.path.dirname(self.path)
+      if not os.path.isdir(dirpath): os.makedirs(dirpath)
+      tmppath = self.path + ".tmp"
+      with open(tmppath, "w") as f:
+        f.write("".join(line + "\n" for line in lines))
+      os.rename(tmppath, self.path) # atomic replace
+      return True
+    except (IOError, OSError), exc:
+      wrn_resp("fail to save %s - %s" % (self.name, exc))
+      return False
+
+# ReplayGain per local file, stored in LOUDNESS_FILE as lines of
+#   MTIME <TAB> GAIN-DB <TAB> PEAK <TAB> PATH
+# An entry is valid while the file has the same mtime.
+class LoudnessStore(object):
+  def __init__(self, path=LOUDNESS_FILE, maxentries=LOUDNESS_MAX_ENTRIES):
+    self.file = TabFile(path, "loudness")
+    self.maxentries = maxentries
+    self.entries = dict() # path -> (mtime, gain-dB, peak)
+    self.dirty = False
+    self.load()
+
+  def load(self):
+    for fields in self.file.rows(4):
+      try: self.entries[fields[3]] = (int(fields[0]), float(fields[1]),
+                                      float(fields[2]))
+      except ValueError: pass
+
+  def get(self, path):
+    "(gain-dB, peak) or None if unknown or file was modified"
+    entry = self.entries.get(path)
+    if not entry: return None
+    try:
+      if int(os.path.getmtime(path)) != entry[0]: return None
+    except OSError: return None
+    return entry[1:]
+
+  def set(self, path, mtime, gain, peak):
+    if self.entries.get(path) != (mtime, gain, peak):
+      self.entries[path] = (mtime, gain, peak)
+      self.dirty = True
+
+  def flush(self):
+    if self.dirty:
+      items = self.entries.items()
+      if len(items) > self.maxentries: # drop oldest files
+        items.sort(key=lambda item: item[1][0], reverse=True)
+        items = items[:self.maxentries]
+        self.entries = dict(items)
+      if self.file.save("%d\t%.2f\t%.6f\t%s" % (mtime, gain, peak, path)
+                        for (path, (mtime, gain, peak)) in items):
+        self.dirty = False
+    return True # for timeout_add
+
+# Analyze local files by analyze(path) in a low priority worker thread,
+# results are stored in main thread.
+class LoudnessAnalyzer(object):
+  def __init__(self, store, analyze, idle_add, on_result=None):
+    (self.store, self.analyze, self.idle_add) = (store, analyze, idle_add)
+    self.on_result = on_result # on_result(path, gain, peak) in main thread
+    self.jobs = Queue.Queue()
+    self.queued = set()
+    self.thread = None
+
+  def submit(self, path):
+    "Queue path unless known or queued"
+    if (path in self.queued) or self.store.get(path): return False
+    if self.thread is None:
+      self.thread = threading.Thread(target=self.run)
+      self.thread.daemon = True
+      self.thread.start()
+    self.queued.add(path)
+    self.jobs.put(path)
+    return True
+
+  def run(self):
+    while True:
+      path = self.jobs.get()
+      try:
+        if self.store.get(path): # e.g. found ReplayGain tags meanwhile
+          self.idle_add(self.queued.discard, path)
+          continue
+        mtime = int(os.path.getmtime(path))
+        (gain, peak) = self.analyze(path)
+        self.idle_add(self.finish, path, mtime, gain, peak)
+      except Exception, exc:
+        self.idle_add(self.fail, path, exc)
+
+  def finish(self, path, mtime, gain, peak):
+    self.queued.discard(path)
+    self.store.set(path, mtime, gain, peak)
+    if self.on_result: self.on_result(path, gain, peak)
+    return False
+
+  def fail(self, path, exc):
+    self.queued.discard(path)
+    wrn_resp("fail to analyze loudness - %s" % exc)
+    return False
+
+def _posix_fadvise():
+  "libc posix_fadvise by ctypes, None if unavailable (e.g. os-x)"
+  try:
+    import ctypes, ctypes.util
+    func = ctypes.CDLL(ctypes.util.find_library("c")).posix_fadvise
+  except (ImportError, OSError, AttributeError): return None
+  func.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong,
+                   ctypes.c_int]
+  return func
+
+def warm_file(path, nbytes, rate=PREFETCH_RATE, fadvise=None):
+  "Read head of path (nbytes) into page cache at rate MB/s, returns bytes read"
+  done = 0
+  with open(path, "rb") as f:
+    if fadvise: fadvise(f.fileno(), 0, nbytes, POSIX_FADV_WILLNEED)
+    started = time.time()
+    while done < nbytes:
+      data = f.read(min(PREFETCH_CHUNK, nbytes - done))
+      if not data: break
+      done += len(data)
+      ahead = done / (rate * 1048576.0) - (time.time() - started)
+      if ahead > 0: time.sleep(ahead)
+  return done
+
+# Prefetched files and hit counters, stored in PREFETCH_FILE
+# (shared by successive player processes) as lines of
+#   #counters HITS MISSES BYTES
+#   MTIME <TAB> BYTES <TAB> UNIX-TIME <TAB> PATH
+# A load is a hit only within `fresh' seconds after warming.
+# Updates are kept in memory until flush() (called by timer and at quit).
+class PrefetchLog(object):
+  def __init__(self, path=PREFETCH_FILE, maxentries=PREFETCH_MAX_ENTRIES,
+               fresh=PREFETCH_FRESH):
+    self.file = TabFile(path, "prefetch")
+    (self.maxentries, self.fresh) = (maxentries, fresh)
+    self.entries = dict() # path -> (mtime, bytes, unix-time)
+    (self.hits, self.misses, self.nbytes) = (0, 0, 0)
+    self.dirty = False
+    self.load()
+
+  def load(self):
+    for line in self.file.load():
+      try:
+        if line.startswith("#counters "):
+          (self.hits, self.misses, self.nbytes) = \
+              [int(v) for v in line.split()[1:4]]
+          continue
+        fields = line.split("\t", 3)
+        if len(fields) < 4: continue
+        entry = tuple(int(v) for v in fields[:3])
+        if self.is_fresh(entry): self.entries[fields[3]] = entry
+      except ValueError: pass
+
+  def is_fresh(self, entry):
+    return time.time() - entry[2] < self.fresh
+
+  def add(self, path, mtime, nbytes):
+    self.entries[path] = (mtime, nbytes, int(time.time()))
+    self.nbytes += nbytes
+    self.dirty = True
+
+  def check(self, path):
+    "Count hit or miss of loading path, returns True if recently prefetched"
+    entry = self.entries.pop(path, None)
+    try: hit = bool(entry) and entry[0] == int(os.path.getmtime(path)) \
+          and self.is_fresh(entry)
+    except OSError: return False
+    if hit: self.hits += 1
+    else: self.misses += 1
+    self.dirty = True
+    return hit
+
+  def flush(self):
+    if self.dirty:
+      items = sorted([item for item in self.entries.items()
+                      if self.is_fresh(item[1])],
+                     key=lambda item: item[1][2], reverse=True)
+      self.entries = dict(items[:self.maxentries])
+      counters = (self.hits, self.misses, self.nbytes)
+      if self.file.save(["#counters %d %d %d" % counters]
+                        + ["%d\t%d\t%d\t%s" % (entry + (path,))
+                           for (path, entry) in items[:self.maxentries]]):
+        self.dirty = False
+    return True # for timeout_add
+
+# Warm page cache for the upcoming local tracks in a background thread,
+# budget (MB) is shared by the latest `tracks' paths.
+class Prefetcher(object):
+  def __init__(self, log, idle_add, budget=PREFETCH_BUDGET,
+               tracks=PREFETCH_TRACKS):
+    (self.log, self.idle_add) = (log, idle_add)
+    (self.budget, self.tracks) = (budget, tracks)
+    self.cond = threading.Condition()
+    self.pending = []
+    self.current = None # path in progress
+    self.thread = None
+    self.fadvise = _posix_fadvise()
+
+  def add(self, path):
+    if self.budget <= 0 or self.tracks <= 0: return False
+    with self.cond:
+      if (path in self.pending) or (path == self.current): return False
+      self.pending.append(path)
+      del self.pending[:-self.tracks] # keep the latest
+      self.cond.notify()
+    if self.thread is None:
+      self.thread = threading.Thread(target=self.run)
+      self.thread.daemon = True
+      self.thread.start()
+    return True
+
+  def discard(self, path):
+    with self.cond:
+      if path in self.pending: self.pending.remove(path)
+
+  def clear(self):
+    with self.cond: self.pending = []
+
+  def run(self):
+    while True:
+      with self.cond:
+        while not self.pending: self.cond.wait()
+        path = self.current = self.pending.pop(0)
+        nbytes = self.budget * 1048576 // self.tracks
+      try:
+        mtime = int(os.path.getmtime(path))
+        nbytes = warm_file(path, nbytes, PREFETCH_RATE, self.fadvise)
+        self.idle_add(self.finish, path, mtime, nbytes)
+      except (IOError, OSError), exc:
+        self.idle_add(wrn_resp, "fail to prefetch - %s" % exc)
+      self.current = None
+
+  def finish(self, path, mtime, nbytes):
+    self.log.add(path, mtime, nbytes)
+    return False
+
+class _HeadRequest(urllib2.Request):
+  def get_method(self): return "HEAD"
+
+class _HeadRedirectHandler(urllib2.HTTPRedirectHandler):
+  "Follow redirects of HEAD request by HEAD (urllib2 switches to GET)"
+  def redirect_request(self, req, fp, code, msg, headers, newurl):
+    new = urllib2.HTTPRedirectHandler.redirect_request(
+      self, req, fp, code, msg, headers, newurl)
+    if new and req.get_method() == "HEAD":
+      new = _HeadRequest(new.get_full_url(), headers=new.headers,
+                         origin_req_host=new.get_origin_req_host(),
+                         unverifiable=True)
+    return new
+
+def resolve_url(url, timeout=RESOLVE_TIMEOUT):
+  """Final url after redirects of http url.
+  HEAD not to take a listener slot of live stream, ranged GET (closed after
+  headers) if the server refuses HEAD"""
+  try:
+    f = _opener_open(urllib2.build_opener(_HeadRedirectHandler),
+                     _HeadRequest(url), timeout)
+  except urllib2.HTTPError, exc:
+    if exc.code not in (400, 405, 501): raise
+    f = _urlopen(urllib2.Request(url, headers={"Range":"bytes=0-0"}),
+                 timeout=timeout)
+  try: return f.geturl()
+  finally: f.close()
+
+# Redirect target per station url, stored in RESOLVE_FILE as lines of
+#   EXPIRE-UNIX-TIME <TAB> FINAL-URL <TAB> URL
+# Resolution runs in background threads, results are stored in main thread.
+class ResolveCache(object):
+  def __init__(self, idle_add, path=RESOLVE_FILE, ttl=RESOLVE_TTL,
+               maxentries=RESOLVE_MAX_ENTRIES):
+    self.idle_add = idle_add
+    self.file = TabFile(path, "resolve")
+    (self.ttl, self.maxentries) = (ttl, maxentries)
+    self.entries = dict() # url -> (final-url, expire)
+    self.pending = set()
+    self.load()
+
+  def load(self):
+    for fields in self.file.rows(3):
+      if "\t" in fields[2]: continue # old format with addresses
+      try: self.entries[fields[2]] = (fields[1], int(fields[0]))
+      except ValueError: pass
+
+  def get(self, url):
+    "Cached final url, None if unknown or expired"
+    entry = self.entries.get(url)
+    if entry and entry[1] > time.time(): return entry[0]
+    return None
+
+  def invalidate(self, url):
+    if self.entries.pop(url, None): self.flush()
+
+  def resolve(self, url):
+    "Start resolution of url unless fresh or in progress"
+    if self.get(url) or (url in self.pending): return False
+    self.pending.add(url)
+    thread = threading.Thread(target=self.run, args=(url,))
+    thread.daemon = True
+    thread.start()
+    return True
+
+  def run(self, url):
+    try:
+      self.idle_add(self.finish, url, resolve_url(url))
+    except Exception, exc: # IOError, socket.error, httplib.HTTPException
+      self.idle_add(self.fail, url, exc)
+
+  def finish(self, url, final):
+    self.pending.discard(url)
+    self.entries[url] = (final, int(time.time() + self.ttl))
+    _puts("resolved %s -> %s", url, final)
+    self.flush()
+    return False
+
+  def fail(self, url, exc):
+    self.pending.discard(url)
+    _puts("fail to resolve %s - %s", url, exc)
+    return False
+
+  def items(self):
+    "[(url, final-url, expire)...], fresh only"
+    now = time.time()
+    return [(url, final, expire) for (url, (final, expire))
+            in sorted(self.entries.items()) if expire > now]
+
+  def flush(self):
+    items = sorted(self.items(), key=lambda item: item[2],
+                   reverse=True)[:self.maxentries]
+    self.entries = dict((url, (final, expire))
+                        for (url, final, expire) in items)
+    self.file.save("%d\t%s\t%s" % (expire, final, url)
+                   for (url, final, expire) in items)
+
+# Resume position per uri, stored in BOOKMARK_FILE as lines of
+#   POSITION-SEC <TAB> UNIX-TIME <TAB> URI
+# Updates are kept in memory until flush() (called by timer and at quit).
+class BookmarkStore(object):
+  def __init__(self, path=BOOKMARK_FILE, maxentries=BOOKMARK_MAX_ENTRIES):
+    self.file = TabFile(path, "bookmarks")
+    self.maxentries = maxentries
+    self.entries = dict() # uri -> (position-sec, unix-time)
+    self.dirty = False
+    self.load()
+
+  def load(self):
+    for fields in self.file.rows(3):
+      try: self.entries[fields[2]] = (int(fields[0]), int(fields[1]))
+      except ValueError: pass
+
+  def get(self, uri):
+    entry = self.entries.get(uri)
+    return entry and entry[0]
+
+  def set(self, uri, pos):
+    entry = self.entries.get(uri)
+    if (not entry) or entry[0] != pos:
+      self.entries[uri] = (pos, int(time.time()))
+      self.dirty = True
+
+  def remove(self, uri):
+    if self.entries.pop(uri, None): self.dirty = True
+
+  def clear(self):
+    if self.entries: (self.entries, self.dirty) = (dict(), True)
+
+  def items(self):
+    "[(uri, position, unix-time)...], newest first"
+    items = [(uri, pos, stamp) for (uri, (pos, stamp)) in self.entries.iteritems()]
+    items.sort(key=lambda item: item[2], reverse=True)
+    return items
+
+  def flush(self):
+    if self.dirty:
+      items = self.items()
+      if len(items) > self.maxentries:
+        items = items[:self.maxentries]
+        self.entries = dict((uri, (pos, stamp)) for (uri, pos, stamp) in items)
+      if self.file.save("%d\t%d\t%s" % (pos, stamp, uri)
+                        for (uri, pos, stamp) in items):
+        self.dirty = False
+    return True # for timeout_add
+
+# Commands of both CLIPlayer and CaptureDaemon,
+# which have `sweeper' and `postproc'.
+class CommonCommands(EventCommands):
+  def configure(self, retention=None, postproc=None):
+    "Apply --retention and --postproc options, and start sweeping"
+    if retention: self.sweeper.set_policy(*retention)
+    if postproc:
+      (self.postproc.fmt, self.postproc.trim, self.postproc.remove) = postproc
+    self.sweeper.start()
+
+  def retention_command(self, args=[]):
+    argv = args and args[0].split()
+    if argv:
+      try:
+        max_age = max(0.0, float(argv[0]))
+        if len(argv) > 1: max_bytes = max(0, int(argv[1])) * 1024 * 1024
+        else: max_bytes = self.sweeper.max_bytes
+      except ValueError:
+        err_resp("usage: retention [DAYS [MBYTES]]")
+        return
+      self.sweeper.set_policy(max_age, max_bytes)
+    resp("RETENTION", "max-age=%gd" % self.sweeper.max_age,
+         "max-size=%dMB" % (self.sweeper.max_bytes // (1024 * 1024)))
+
+  def postproc_command(self, args=[]):
+    argv = args and args[0].split()
+    pp = self.postproc
+    if argv:
+      try: (pp.fmt, pp.trim, pp.remove) = parse_postproc_mode(argv)
+      except ValueError:
+        err_resp("usage: postproc [off|wav|flac|ogg [trim] [remove]]")
+        return
+    resp("POSTPROC", "mode", pp.fmt or "off", "trim" if pp.trim else "-",
+         "remove" if pp.remove else "-", "running=%d" % len(pp.running))
+
+(_LOADING, _LOADED, _PLAYING, _PLAYED, _STOPPING, _STOPPED,
+ _PAUSING, _PAUSED ) = range(1, 9)
+
+def is_network_error(err, uri, codes):
+  "Is err a transient read/connect failure (resource error codes) of remote uri"
+  if (not uri) or is_localpath(uri): return False
+  if "resource" not in str(getattr(err, "domain", "")).lower():
+    return False
+  return getattr(err, "code", None) in codes
+
+# States of Engine.get_state/set_state
+ENGINE_STATES = ("VOID_PENDING", "NULL", "READY", "PAUSED", "PLAYING")
+
+# GStreamer backend of CLIPlayer, gaplay.py provides the 0.10 engine and
+# gaplay1.py the 1.x engine.  Bus messages of the player are passed to
+# the listener (see attach) in the main thread by
+#   on_eos(), on_tags(A|V|-, [(key, value)...]),
+#   on_state_changed(old, new, pending) of the top level element,
+#   on_async_done(), on_duration(), on_buffering(percent),
+#   on_warning(err, debug) and on_error(err, debug, is-network-error).
+# Audio caps and level messages are reported by the engine itself.
+class Engine(object):
+  name = None       # e.g. gst0.10
+  script = None     # path of the engine script, runs --postproc-job
+  gst_launch = None # gst-launch command of the same GStreamer version
+  decodebin = None  # decoder element of analyze_loudness
+  features = ()     # optional: timeshift, level
+  sink_conf = SINK_DEFAULT
+  # functions of the main loop, e.g. gobject.idle_add
+  idle_add = timeout_add = source_remove = None
+
+  def attach(self, listener):
+    self.listener = listener
+    self.mainloop_thread = threading.currentThread()
+
+  def analyze_loudness(self, path):
+    "Returns (ReplayGain track gain dB, peak) of path, in worker thread"
+    return analyze_loudness(path, self.gst_launch, self.decodebin)
+
+  def has_element(self, name):
+    raise NotImplementedError
+
+  def uri(self):
+    raise NotImplementedError
+
+  def set_uri(self, uri):
+    raise NotImplementedError
+
+  def get_state(self, timeout=500):
+    "(SUCCESS|ASYNC|FAILURE|..., state, pending-state) waiting timeout msec"
+    raise NotImplementedError
+
+  def set_state(self, state):
+    "Returns SUCCESS|ASYNC|FAILURE|..."
+    raise NotImplementedError
+
+  def play(self):
+    "PLAYING without resetting volume"
+    raise NotImplementedError
+
+  def duration(self, fallback=-1):
+    "nanosec"
+    raise NotImplementedError
+
+  def position(self, fallback=-1):
+    "nanosec"
+    raise NotImplementedError
+
+  def seek(self, nsec, mode="normal"):
+    "mode -- normal|scrub|accurate, returns False if failed"
+    raise NotImplementedError
+
+  def volume(self, vol=None):
+    "Set volume unless None, returns current volume"
+    raise NotImplementedError
+
+  def latency(self):
+    "Latency (nanosec) of audio output or None"
+    return None
+
+  # Record branch: audio-sink tee'd to a wav file (location), which is
+  # (de)selected and rebuilt in NULL state.
+  def is_recording(self):
+    raise NotImplementedError
+
+  def set_recording(self, on):
+    raise NotImplementedError
+
+  def rec_location(self):
+    "Called by sweeper thread too"
+    raise NotImplementedError
+
+  def set_rec_location(self, path):
+    raise NotImplementedError
+
+  def replace_sinks(self, conf):
+    "Rebuild audio sinks by conf (see SINK_DEFAULT)"
+    raise NotImplementedError
+
+  def set_level(self, interval):
+    "level feature, interval msec of LEVEL records or None(off)"
+    raise NotImplementedError
+
+  def open_timeshift(self, seconds, rec_end):
+    "timeshift feature, returns TimeShift of gaplay.py"
+    raise NotImplementedError
+
+  def close_timeshift(self):
+    "Returns recording file finished by closing or None"
+    raise NotImplementedError
+
+# The player of `gaplay.py' (and `gaplay1.py') over an Engine.
+class CLIPlayer(CommonCommands):
+
+  def __init__(self, cmdqueue, engine, normalize=False,
+               prefetch=PREFETCH_BUDGET):
+    self.dispatch_table = {
+      "load":self.load_command, "quit":self.quit, 
+      "play":self.play_command, "stop":self.stop_command,
+      "_pause":self.pause_command, "_resume":self.resume_command,
+      "pause":self.toggle_pause, "replay":self.replay_command,
+      "rec":self.toggle_record, "gain":self.gain,
+      "skip":self.skip_command, "jump":self.jump_command,
+      "scrub":self.scrub_command, "scrub-end":self.scrub_end_command,
+      "load-http":self.load_http,
+      "load-shoutcast":self.load_shoutcast,
+      "state":self.state_command, "info":self.info,
+      "timeshift":self.timeshift_command,
+      "retention":self.retention_command,
+      "postproc":self.postproc_command,
+      "bookmarks":self.bookmarks_command,
+      "sink":self.sink_command,
+      "level":self.level_command,
+      "normalize":self.normalize_command,
+      "analyze":self.analyze_command,
+      "upcoming":self.upcoming_command,
+      "prefetch":self.prefetch_command,
+      "resolve":self.resolve_command,
+      "subscribe":self.subscribe_command,
+      "unsubscribe":self.unsubscribe_command,
+      "error":self.error_command, 
+      "raise":self.raise_command, # for debug
+      "warning":self.warning_command, # for debug
+      }
+
+    self.cmdqueue = cmdqueue
+    # playmode _STOPPED|_PLAYING|_PAUSED
+    self.requests = set()
+    self.recfile_templ = FileTempl(RECFILE_TEMPL)
+    self.paused = False
+    self.paused_pos = -1
+    self.engine = engine
+    self.auto_reconnect = True
+    self.backoff = Backoff()
+    self.reconnect_id = None # main loop source id of pending reconnect
+    self.has_played = False # uri has reached PLAYING, reconnect only then
+    self.timeshift_sec = 0 # time-shift length for live stream, 0:disable
+    self.tshift = None
+    self.switch_start = None # (time, warm|cold) of last play()
+    self.switch_latency = None # (msec, warm|cold) from play() to PLAYING
+    self.bookmarks = BookmarkStore()
+    self.pending_seek = None # seek after prerolled (nanosec)
+    self.seeker = SeekThrottle(self.do_seek, self.engine.timeout_add,
+                               self.engine.source_remove)
+    self.scrub_target = None # nanosec, settled by `scrub-end'
+    self.duration_cache = None
+    self.sweeper = RecordSweeper(self.recfiles_in_use, engine.idle_add)
+    self.sweeper.add(self.recfile_templ)
+    self.postproc = PostProcessor(engine.script, engine.idle_add)
+    self.stream_tags = dict() # tags of current stream for postproc
+    self.normalize = normalize # apply ReplayGain to volume
+    self.user_gain = 1.0 # by `gain' command
+    self.gain_factor = 1.0 # of current track
+    self.loudness = LoudnessStore()
+    self.analyzer = LoudnessAnalyzer(self.loudness, engine.analyze_loudness,
+                                     engine.idle_add, self.loudness_done)
+    self.prefetcher = Prefetcher(PrefetchLog(), engine.idle_add, prefetch)
+    self.resolver = ResolveCache(engine.idle_add)
+    self.origin_uri = None # requested uri, when playing cached redirect target
+    self.loop = None
+    engine.attach(self)
+
+  def start(self, loop):
+    "Register command dispatcher, watchers and flush timers to main loop"
+    self.loop = loop
+    engine = self.engine
+    engine.idle_add(self.dispatch_command)
+    engine.timeout_add(500, self.make_duration_watcher())
+    engine.timeout_add(1000, self.make_stall_watcher())
+    for store in (self.bookmarks, self.loudness, self.prefetcher.log):
+      engine.timeout_add(BOOKMARK_FLUSH_INTERVAL * 1000, store.flush)
+
+
+  # If failed or cannot get_state (only strict=True) then retruns None
+  def get_state_list(self, tmout=500, strict=True):
+    (ret, state, pending) = self.engine.get_state(tmout)
+    if ret == "FAILURE": return None
+    if strict and (ret == "ASYNC"):
+      return None
+    return [state, pending]
+
+  def has_state(self, state, tmout=500, strict=True):
+    stlist = self.get_state_list(tmout, strict)
+    if stlist is None: return False
+    return state in stlist
+
+  def is_stopped(self, stlist=None):
+    "NULL or READY (stopped but audio sink is kept open)"
+    if stlist is None: stlist = self.get_state_list() or []
+    return ("NULL" in stlist) or ("READY" in stlist)
+
+  def query_duration(self, fallback=None):
+    return self.engine.duration(fallback)
+
+  def query_position(self, fallback=None):
+    return self.engine.position(fallback)
+
+  def recfile(self):
+    return self.recfile_templ.nextfile()
+
+  def is_recording(self):
+    return self.engine.is_recording()
+
+  def update_recfile(self):
+    rfile = self.recfile()
+    self.engine.set_rec_location(rfile)
+    return rfile
+
+  def close_recfile(self):
+    location = self.engine.rec_location()
+    self.engine.set_rec_location(None)
+    return location
+
+  def recfiles_in_use(self):
+    "Called by sweeper thread"
+    files = [self.engine.rec_location()]
+    tshift = self.tshift
+    if tshift and tshift.rec: files.append(tshift.rec[1])
+    return [f for f in files if f]
+
+  def rec_finished(self, path):
+    event_resp("rec", "REC", "end", path)
+    self.postproc.submit(path, self.stream_tags)
+
+  def load_command(self, args=[]):
+    filepath = args and args[0]
+    if not filepath:
+      err_resp("usage: load URL|FILEPATH")
+      return
+    uri = path2uri(filepath)
+    if not uri:
+      err_resp("No such file - %s" % filepath)
+      return
+    # self.engine.set_state("NULL") # no need (play->stop)
+    self.set_gain_factor(self.stored_gain(uri))
+    self.origin_uri = uri
+    self.requests.add(_LOADING)
+    self.requests.add(_PLAYING)
+    if not self.play(self.resolved(uri)):
+      self.requests.discard(_LOADING)
+      self.requests.discard(_PLAYING)
+      return
+    path = uri2path(uri)
+    if path:
+      self.prefetcher.discard(path)
+      self.prefetcher.log.check(path)
+    pos = self.bookmarks.get(uri)
+    if pos: self.pending_seek = pos * 1000000000
+
+  def resolved(self, uri):
+    "Cached redirect target of http uri, resolve in background when unknown"
+    if not match_http(uri): return uri
+    final = self.resolver.get(uri)
+    if final: return final
+    self.resolver.resolve(uri) # for next time, not to block loading
+    return uri
+
+  def resolve_command(self, args=[]):
+    """resolve URL: resolve redirects of stream likely to be played next
+    resolve [clear]: list cached redirect targets"""
+    if args and args[0] != "clear":
+      if not match_http(args[0]):
+        err_resp("usage: resolve [URL|clear]")
+        return
+      self.resolver.resolve(args[0])
+      return
+    if args:
+      self.resolver.entries.clear()
+      self.resolver.flush()
+    items = self.resolver.items()
+    for (url, final, expire) in items:
+      resp("RESOLVED", url, final, "ttl=%d" % (expire - time.time()))
+    resp("RESOLVE", len(items))
+
+  def upcoming_command(self, args=[]):
+    "upcoming [FILEPATH]: prefetch FILEPATH, clear upcoming tracks if omitted"
+    path = args and uri2path(args[0])
+    if not args: self.prefetcher.clear()
+    elif path and os.path.isfile(path): self.prefetcher.add(path)
+    else: wrn_resp("cannot prefetch - %s" % args[0])
+
+  def prefetch_command(self, args=[]):
+    "prefetch [MBYTES [TRACKS]]"
+    pf = self.prefetcher
+    argv = args and args[0].split()
+    if argv:
+      try:
+        budget = max(0, int(argv[0]))
+        tracks = max(0, int(argv[1])) if len(argv) > 1 else pf.tracks
+        if len(argv) > 2: raise ValueError
+      except ValueError:
+        err_resp("usage: prefetch [MBYTES [TRACKS]]")
+        return
+      with pf.cond: (pf.budget, pf.tracks) = (budget, tracks)
+      if not (budget and tracks): pf.clear()
+    log = pf.log
+    resp("PREFETCH", "budget=%dMB" % pf.budget, "tracks=%d" % pf.tracks,
+         "hits=%d" % log.hits, "misses=%d" % log.misses,
+         "warmed=%dMB" % (log.nbytes // 1048576),
+         "fadvise" if pf.fadvise else "read")
+
+  def bookmarks_command(self, args=[]):
+    argv = args and args[0].split(None, 1)
+    if not argv:
+      items = self.bookmarks.items()
+      # write at once, it can be thousands of lines
+      sys.stdout.write("".join(
+          "->BOOKMARK %s %s\n" % (sec2str(pos), to_s(uri))
+          for (uri, pos, stamp) in items))
+      resp("BOOKMARKS", len(items))
+    elif argv[0] == "clear" and len(argv) == 1:
+      self.bookmarks.clear()
+      resp("BOOKMARKS", 0)
+    elif argv[0] == "delete" and len(argv) == 2:
+      self.bookmarks.remove(path2uri(argv[1]) or argv[1])
+      resp("BOOKMARKS", len(self.bookmarks.entries))
+    else:
+      err_resp("usage: bookmarks [clear|delete URI]")
+
+  def play_command(self, args=[]):
+    self.requests.add(_PLAYING)
+    if not self.play():
+      self.requests.discard(_PLAYING)
+
+  def play(self, uri=None):
+    # Switch track in READY keeping audio device and elements,
+    # but NULL when audio-sink is replaced
+    newuri = uri or self.engine.uri()
+    warm = not (self.tshift or self.wants_timeshift(newuri))
+    self.switch_start = (time.time(), "warm" if warm else "cold")
+    self.stop("READY" if warm else "NULL")
+    if uri:
+      self.engine.set_uri(uri)
+      self.stream_tags.clear()
+      self.has_played = False
+    self.open_timeshift(newuri)
+    if self.is_recording(): 
+      f = self.update_recfile()
+      event_resp("rec", "REC", "start", f)
+    # self.engine.set_state("PLAYING")
+    self.engine.play()
+    return True
+    
+  def stop_command(self, args=[]):
+    if self.stop(): event_resp("state", "STOP")
+
+  def stop(self, state="NULL"):
+    (self.paused, self.paused_pos) = (False, -1)
+    self.pending_seek = None
+    self.cancel_seek()
+    self.duration_cache = None
+    self.cancel_reconnect()
+    self.engine.set_state(state)
+    if self.tshift: self.close_timeshift()
+    if self.is_recording():
+      f = self.close_recfile()
+      if f: self.rec_finished(f)
+    return True
+      
+  def wants_timeshift(self, uri):
+    "Time-shift http stream when enabled (but not with recsink)"
+    return (self.timeshift_sec > 0) and \
+        ("timeshift" in self.engine.features) and bool(uri) and \
+        bool(match_http(uri)) and not self.is_recording()
+
+  def open_timeshift(self, uri):
+    if not self.wants_timeshift(uri): return
+    self.tshift = self.engine.open_timeshift(self.timeshift_sec,
+                                             self.rec_finished)
+
+  def close_timeshift(self):
+    f = self.engine.close_timeshift()
+    if f: self.rec_finished(f)
+    self.tshift = None
+
+  def supports(self, feature):
+    "Optional feature of the engine, WARNING if not supported"
+    if feature in self.engine.features: return True
+    wrn_resp("%s is not supported by %s engine" % (feature, self.engine.name))
+    return False
+
+  def timeshift_command(self, args=[]):
+    if args:
+      try:
+        self.timeshift_sec = max(0, int(args[0]))
+      except ValueError:
+        err_resp("usage: timeshift [SEC]")
+        return
+      if self.timeshift_sec: self.supports("timeshift")
+    if self.tshift:
+      resp("TIMESHIFT", self.timeshift_sec, "delay=%s" %
+           sec2str(nano2sec(self.tshift.delay())))
+    else: resp("TIMESHIFT", self.timeshift_sec)
+
+  def schedule_reconnect(self, uri, reason):
+    "Restart uri after backoff delay, returns False when gave up"
+    if self.reconnect_id is not None: return True
+    if self.backoff.exhausted():
+      err_resp("give up reconnecting - %s" % uri)
+      return False
+    self.engine.set_state("NULL")
+    if self.is_recording():
+      f = self.close_recfile()
+      if f: self.rec_finished(f)
+    delay = self.backoff.next_delay()
+    resp("RECONNECT", self.backoff.attempts, "%.1f" % delay, reason, uri)
+    self.reconnect_id = self.engine.timeout_add(int(delay * 1000),
+                                            self.reconnect, uri)
+    return True
+
+  def reconnect(self, uri):
+    self.reconnect_id = None
+    # user has already restarted or loaded another uri
+    if (not self.has_state("NULL")) or \
+          self.engine.uri() != uri:
+      return False
+    if self.is_recording(): # continue with next file of recfile_templ
+      f = self.update_recfile()
+      event_resp("rec", "REC", "start", f)
+    self.requests.add(_PLAYING)
+    self.engine.play()
+    return False
+
+  def cancel_reconnect(self):
+    if self.reconnect_id is not None:
+      self.engine.source_remove(self.reconnect_id)
+      self.reconnect_id = None
+    self.backoff.reset()
+
+  def replay_command(self, args=[]):
+    self.stop("READY")
+    event_resp("state", "STOP")
+    self.play_command(args)
+    # Suppress `Warning: gsignal.c:2576: instance has no handler with id ...'
+    time.sleep(0.1)
+
+  def pause_command(self, args=[]):
+    self.requests.add(_PAUSING)
+    if not self.pause():
+      self.requests.discard(_PAUSING)
+
+  def pause(self):
+    if not self.has_state("PLAYING"):
+      wrn_resp("Fail to pause - not playing")
+      return False
+    if self.tshift: # keep capturing live stream
+      self.tshift.set_paused(True)
+      self.requests.discard(_PAUSING)
+      event_resp("state", "PAUSE")
+      return True
+    self.paused = True
+    if self.query_duration(-1) > 0 :
+      self.paused_pos = self.query_position(-1)
+    else: self.paused_pos = -1
+
+    if self.is_recording():
+      self.engine.set_state("NULL")
+      f = self.close_recfile()
+      if f: self.rec_finished(f)
+    else:
+      ret = self.engine.set_state("PAUSED")
+      if ret == "ASYNC":
+        _puts("Return STATE_CHANGE_ASYNC")
+    return True
+
+  def resume_command(self, args=[]):
+    self.requests.add(_PLAYING)
+    if not self.resume():
+      self.requests.discard(_PLAYING)
+
+  def resume(self):
+    self.paused = False
+    if self.tshift and self.tshift.paused and \
+          self.has_state("PLAYING"):
+      self.tshift.set_paused(False)
+      self.requests.discard(_PLAYING)
+      event_resp("state", "PLAY")
+      return True
+    if self.has_state("PLAYING"):
+      wrn_resp("Fail to resume - already playing")
+      return False
+    if self.has_state("PAUSED"):
+      self.paused_pos = -1
+      # not recording before paused
+      if self.is_recording():
+        err_resp("programing bug, will stop")
+        self.stop()
+        return False
+      self.engine.set_state("PLAYING")
+      return True
+    else:
+      if not self.is_stopped():
+        wrn_resp("Has not NULL/READY state and PAUSED state")
+      if self.is_recording():
+        f = self.update_recfile()
+        event_resp("rec", "REC", "start", f)
+      if self.paused_pos > 0:
+        self.engine.set_state("PAUSED")
+        time.sleep(0.2) # Fix-me MADA
+        self.engine.seek(self.paused_pos)
+      self.paused_pos = -1
+      #self.engine.set_state("PLAYING")
+      self.engine.play()
+      return True
+
+  def toggle_pause(self, args=[]):
+    stlist = (self.get_state_list() or [])
+    if self.tshift and ("PLAYING" in stlist):
+      self.tshift.set_paused(not self.tshift.paused)
+      event_resp("state", "PAUSE" if self.tshift.paused else "PLAY")
+      return True
+    if "PLAYING" in stlist:
+      # will pause
+      if self.paused: wrn_resp("Duplicated pause command")
+      if _PAUSING in self.requests: wrn_resp("Already pausing")
+
+      self.paused = True
+      if self.query_duration(-1) > 0 :
+        self.paused_pos = self.query_position(-1)
+      else: self.paused_pos = -1
+
+      self.requests.add(_PAUSING)
+      if self.is_recording():
+        self.engine.set_state("NULL")
+        f = self.close_recfile()
+        if f: self.rec_finished(f)
+      else:
+        ret = self.engine.set_state("PAUSED")
+        if ret == "ASYNC":
+          wrn_resp("set_state returns STATE_CHANGE_ASYNC")
+      return True
+
+    elif "PAUSED" in stlist:
+      if _PLAYING in self.requests: wrn_resp("Already has playing-request")
+      # will resume play and not recording
+      (self.paused, self.paused_pos ) = (False , -1)
+      # not recording before paused
+      if self.is_recording():
+        err_resp("programing bug, will stop")
+        self.stop()
+        return False
+      self.requests.add(_PLAYING)
+      self.engine.set_state("PLAYING")
+      return True
+
+    else:
+      if not self.is_stopped(stlist): # When cannot get_state
+        wrn_resp("player has not NULL/READY or PAUSED or PLAYING state")
+      if _PLAYING in self.requests: wrn_resp("Already has playing-request")
+      # will resume to play after recording-pause or after stop
+      pos = self.paused_pos
+      (self.paused, self.paused_pos ) = (False , -1)
+
+      if self.is_recording():
+        f = self.update_recfile()
+        event_resp("rec", "REC", "start", f)
+
+      if pos > 0: # seek to just a paused positon
+        self.engine.set_state("PAUSED")
+        time.sleep(0.2) # Fix-me MADA
+        self.engine.seek(pos)
+      self.requests.add(_PLAYING)
+      #self.engine.set_state("PLAYING")
+      self.engine.play()
+      return True
+      
+  def toggle_record(self, args=[]):
+    if self.tshift:
+      self.toggle_timeshift_record(args)
+      return
+    pos = -1
+    playing = self.has_state("PLAYING")
+    if playing:
+      if self.query_duration(-1) > 0:
+        pos = self.query_position(-1)
+
+    self.engine.set_state("NULL")
+    if self.is_recording():
+      f = self.close_recfile()
+      if f: self.rec_finished(f)
+      self.engine.set_recording(False)
+      _puts("Stop recording")
+    else:
+      f = self.update_recfile()
+      self.engine.set_recording(True)
+      event_resp("rec", "REC", "start", f)
+      
+    if playing:
+      if pos >= 0:
+        self.engine.set_state("PAUSED")
+        time.sleep(0.2) # Fix-me MADA
+        self.engine.seek(pos)
+      #self.engine.set_state("PLAYING")
+      self.engine.play()
+
+  def toggle_timeshift_record(self, args):
+    "Record from the ring buffer, starting SEC (or preroll) in the past"
+    f = self.tshift.stop_record()
+    if f:
+      self.rec_finished(f)
+      return
+    sec = TIMESHIFT_REC_PREROLL
+    if args:
+      try: sec = max(0, int(args[0]))
+      except ValueError:
+        err_resp("usage: rec [SEC]")
+        return
+    try:
+      f = self.tshift.start_record(self.recfile_templ, sec * 1000000000)
+    except IOError, exc:
+      err_resp("fail to record - %s" % exc)
+      return
+    event_resp("rec", "REC", "start", f)
+
+  def sink_command(self, args=[]):
+    argv = args and args[0].split()
+    sink_conf = self.engine.sink_conf
+    if argv:
+      try:
+        conf = parse_sink_args(argv, sink_conf, self.engine.has_element)
+      except ValueError, exc:
+        err_resp("%s (usage: sink [ELEMENT [DEVICE]] [KEY=VALUE]... [%s])"
+                 % (exc, "|".join(sorted(SINK_PROFILES.keys()))))
+        return
+      if conf != sink_conf: self.replace_sink(conf)
+    latency = self.engine.latency()
+    resp("SINK", " ".join("%s=%s" % (k, self.engine.sink_conf[k])
+                          for k in SINK_KEYS),
+         "latency=%s" % ("-" if latency is None else
+                         "%.1fms" % (latency / 1000000.0)))
+
+  def level_command(self, args=[]):
+    "level [on [MSEC]|off]"
+    argv = args and args[0].split()
+    if argv:
+      try:
+        if argv[0] == "on" and len(argv) <= 2:
+          interval = int(argv[1]) if len(argv) == 2 else LEVEL_INTERVAL
+          if interval <= 0: raise ValueError
+        elif argv == ["off"]: interval = None
+        else: raise ValueError
+      except ValueError:
+        err_resp("usage: level [on [MSEC]|off]")
+        return
+      if self.supports("level"): self.engine.set_level(interval)
+    interval = self.engine.sink_conf.get("level")
+    if interval: resp("LEVEL", "on", interval)
+    else: resp("LEVEL", "off")
+
+  def replace_sink(self, conf):
+    "Rebuild audio sinks (device change needs NULL state)"
+    if self.tshift: # the engine replaces the output of time-shift only
+      self.engine.replace_sinks(conf)
+      return
+    pos = -1
+    playing = self.has_state("PLAYING")
+    if playing and (self.query_duration(-1) > 0):
+      pos = self.query_position(-1)
+    self.engine.set_state("NULL")
+    recording = self.is_recording()
+    if recording:
+      f = self.close_recfile()
+      if f: self.rec_finished(f)
+    self.engine.replace_sinks(conf) # keeps record branch selected
+    if recording and playing:
+      event_resp("rec", "REC", "start", self.update_recfile())
+    if playing:
+      if pos >= 0: self.pending_seek = pos
+      self.engine.play()
+
+  def quit(self, args=[]):
+    self.stop_command()
+    self.bookmarks.flush()
+    self.loudness.flush()
+    self.prefetcher.log.flush()
+    time.sleep(0.2) # no need
+    self.loop.quit()
+    
+  def gain(self, args=[]):
+    if args:
+      self.user_gain = float(args[0])
+      self.apply_gain()
+    resp("GAIN", self.user_gain)
+
+  def apply_gain(self):
+    factor = self.gain_factor if self.normalize else 1.0
+    self.engine.volume(min(10.0, self.user_gain * factor))
+
+  def set_gain_factor(self, factor):
+    if factor != self.gain_factor:
+      self.gain_factor = factor
+      self.apply_gain()
+
+  def stored_gain(self, uri):
+    "Gain factor of uri by cached analysis, queue analysis when unknown"
+    path = uri2path(uri)
+    if not (self.normalize and path): return 1.0
+    result = self.loudness.get(path)
+    if result: return gain_factor(*result)
+    self.analyzer.submit(path) # for next time, not to change volume midway
+    return 1.0
+
+  def replaygain_tags(self, rgtags):
+    "Honour embedded ReplayGain tags of current stream"
+    gain = rgtags.get("replaygain-track-gain")
+    if gain is None: return
+    peak = rgtags.get("replaygain-track-peak", 1.0)
+    path = uri2path(self.engine.uri() or "")
+    if path:
+      try: self.loudness.set(path, int(os.path.getmtime(path)), gain, peak)
+      except OSError: pass
+    if self.normalize: self.set_gain_factor(gain_factor(gain, peak))
+
+  def loudness_done(self, path, gain, peak):
+    event_resp("loudness", "LOUDNESS", "gain=%.2fdB" % gain,
+               "peak=%.3f" % peak, path)
+
+  def normalize_command(self, args=[]):
+    "normalize [on|off]"
+    argv = args and args[0].split()
+    if argv:
+      if argv not in (["on"], ["off"]):
+        err_resp("usage: normalize [on|off]")
+        return
+      self.normalize = (argv[0] == "on")
+      uri = self.engine.uri()
+      self.gain_factor = self.stored_gain(uri) if uri else 1.0
+      self.apply_gain()
+    resp("NORMALIZE", "on" if self.normalize else "off",
+         "factor=%.3f" % self.gain_factor)
+
+  def analyze_command(self, args=[]):
+    "analyze FILEPATH: queue loudness analysis, e.g. of upcoming track"
+    path = args and uri2path(args[0])
+    if not (path and os.path.isfile(path)):
+      err_resp("usage: analyze FILEPATH")
+      return
+    result = self.loudness.get(path)
+    if result: self.loudness_done(path, *result)
+    else: self.analyzer.submit(path)
+    
+  def show_state(self): # for debug
+    states = self.engine.get_state(500)
+    if states:
+      resp("STATE", states[0], tuple(states[1:]))
+    else: resp("STATE", "none")
+
+  def info(self, args=[]):
+    uri = self.engine.uri()
+    volume = self.engine.volume()
+    latency = "-"
+    if self.switch_latency: latency = "%dms(%s)" % self.switch_latency
+    resp("INFO", "uri=%s gain=%s switch=%s engine=%s" % (
+        (uri or "none"), volume, latency, self.engine.name))
+    if _isdebug:
+      self.show_state()
+      resp("REQS", tuple(self.requests))
+
+  def seek_timeshift(self, nsec, incremental):
+    live = self.query_position(-1)
+    if live < 0:
+      wrn_resp("cannot seek")
+      return
+    if incremental: delay = self.tshift.delay() - nsec
+    else: delay = live - nsec
+    delay = self.tshift.set_delay(delay)
+    resp("SEEK", "%s/-1" % sec2str(nano2sec(max(0, live - delay))))
+
+  def seek(self, nsec, incremental=False, mode="normal"):
+    if self.tshift:
+      if self.query_duration(-1) <= 0:
+        return self.seek_timeshift(nsec, incremental)
+      self.tshift.flush() # finite remote file, seek the source
+    if self.is_recording():
+      wrn_resp("cannot seek when recording")
+      return
+    if self.is_stopped():
+      wrn_resp("fail to seek - not playing")
+      return
+    dur = self.cached_duration()
+    if dur <= 0:
+      wrn_resp("cannot seek")
+      return
+    if incremental:
+      pos = self.seek_base()
+      if pos < 0:
+        wrn_resp("cannot seek")
+        return
+      nsec = pos + nsec
+    newpos = min(dur, max(0, nsec))
+    self.scrub_target = (newpos if mode == "scrub" else None)
+    self.seeker.request(newpos, mode)
+
+  def cached_duration(self):
+    if self.duration_cache is None:
+      dur = self.query_duration(-1)
+      if dur > 0: self.duration_cache = dur
+      return dur
+    return self.duration_cache
+
+  def seek_base(self):
+    "Position which incremental seek starts from"
+    target = self.seeker.target()
+    return self.query_position(-1) if target is None else target
+
+  def do_seek(self, nsec, mode):
+    return self.engine.seek(nsec, mode)
+
+  def cancel_seek(self):
+    self.seeker.cancel()
+    self.scrub_target = None
+
+  def seek_done(self):
+    "Called on ASYNC_DONE, report achieved position unless seeking again"
+    if self.seeker.done(): return
+    (dur, pos) = (self.cached_duration(), self.query_position(-1))
+    if pos >= 0:
+      resp("SEEK", "%s/%s" % (sec2str( nano2sec(pos) ),
+                              sec2str( nano2sec(dur))))
+
+  def skip_command(self, args=[]):
+    sec = args and int( args[0] )
+    if not sec:
+      err_resp("usage: skip SEC")
+      return
+    return self.seek(sec * 1000000000, True)
+
+  def jump_command(self, args=[]):
+    sec = args and int( args[0] )
+    if (not sec) and (sec != 0):
+      err_resp("usage: jump SEC")
+      return
+    return self.seek(sec * 1000000000, False)
+
+  def scrub_command(self, args=[]):
+    "scrub [+-]SEC: fast key-unit seek, relative when signed"
+    try:
+      (arg, ) = args
+      sec = int(arg)
+    except ValueError:
+      err_resp("usage: scrub [+-]SEC")
+      return
+    return self.seek(sec * 1000000000, arg[0] in "+-", "scrub")
+
+  def scrub_end_command(self, args=[]):
+    "Settle scrubbing by one accurate seek"
+    if self.scrub_target is None: return
+    if self.is_stopped():
+      self.scrub_target = None
+      return
+    self.seeker.request(self.scrub_target, "accurate")
+    self.scrub_target = None
+      
+  def raise_command(self, args=[]):  # for debug
+    raise Exception(*args)
+
+  def error_command(self, args=[]): 
+    err_resp(*args)
+
+  def warning_command(self, args=[]): 
+    wrn_resp(*args)
+
+  def state_command(self, args=[]):  # for debug
+    skey = args and args[0]
+    if skey:
+      state = skey.upper()
+      if state in ENGINE_STATES:
+        _puts("begin set_state %s", skey)
+        ret = self.engine.set_state(state)
+        _puts("end set_state %s", skey)
+        if ret == "ASYNC":
+          _puts("Return STATE_CHANGE_ASYNC")
+      else: err_resp("No state key - %s" % skey)
+    self.show_state()
+
+  def load_http(self, args=[]):
+    uri = args and args[0]
+    if not uri:
+      err_resp("usage: load-http URL")
+      return
+    if match_http(uri):
+      plsinfo = get_playlist(self.resolved(uri), False,
+                             timeout=LOAD_PLAYLIST_TIMEOUT)
+      if isinstance(plsinfo, dict):
+        resp("PLAYLIST-BEGIN", plsinfo.get("_type","-"), uri)
+        for num, entry in enumerate(plsinfo.get("_entries", [])):
+          num = num + 1
+          if entry.get("file"): resp(">", num, "path", entry.get("file",""))
+          if entry.get("length"): resp(">", num, "duration %d" % entry.get("length",-1))
+          if entry.get("title"): resp(">", num, "title", entry.get("title",""))
+        resp("PLAYLIST-END")
+        return
+    self.load_command(args)
+
+  def load_shoutcast(self, args=[]):
+    (entrynum, plspath) = args[0].split(None,1)
+    entrynum = int(entrynum)
+    if not match_uri(plspath): # convert to abspath when localpath 
+      plspath = os.path.abspath( os.path.expanduser(plspath) )
+
+    # Get playlist contents
+    plsinfo = get_playlist(self.resolved(plspath), True,
+                           timeout=LOAD_PLAYLIST_TIMEOUT)
+    entries = plsinfo.get("_entries")
+    if not entries:
+      wrn_resp("playlist has no entry - %s" % plspath)
+      return
+    # Select playlist entry
+    if entrynum == 0:
+      entrynum = random.randrange(1,len(entries)+1)
+    elif entrynum > 0:
+      entrynum = min(entrynum, len(entries))
+    else:
+      entrynum = len(entries)
+    entry = entries[entrynum - 1]
+
+    loadpath = entry.get("file")
+    if not loadpath:
+      wrn_resp("playlist entry has not `file' attribute")
+      return
+    if match_uri2(plspath): # http|https|ftp playlist
+      if is_localpath(loadpath):
+        wrn_resp("remote playlist entry has local-path - %s" % loadpath)
+        return
+    elif not match_uri(plspath): #localfile playlist except file:
+      if not match_uri(loadpath):
+        loadpath = os.path.join( os.path.dirname(plspath), loadpath)
+    _puts("playlist loadpath=%s", loadpath)
+    # playlist response
+    if match_uri(plspath): plsuri = plspath
+    else:
+      plsuri= "file://" + urllib.pathname2url(plspath)
+    resp("SHOUTCAST", plsuri, entrynum,
+         entry.get("length",-1), entry.get("title",""))
+    # load
+    self.load_command([loadpath])
+
+  def make_duration_watcher(self):
+    _oldvalues = [-1, -1, 0] # duration, position, tick
+    def _output():
+      if not _events.wants("time"):
+        # query only for bookmarks (every 5 sec)
+        _oldvalues[2] += 1
+        if _oldvalues[2] % 10: return True
+      if self.has_state("PLAYING"):
+        (dur, pos) = (self.query_duration(None), self.query_position(None))
+        if (dur is not None) and (pos is not None):
+          if dur >= 0:
+            dur = nano2sec(dur)
+          else: dur = -1
+          if pos >= 0:
+            if self.tshift: pos = max(0, pos - self.tshift.delay())
+            pos = nano2sec(pos)
+          else: pos = -1
+          if (pos != _oldvalues[1]) or (dur != _oldvalues[0]):
+            (_oldvalues[0], _oldvalues[1]) = (dur, pos)
+            if (dur >= BOOKMARK_MIN_DURATION) and (pos >= 0) and \
+                  (self.pending_seek is None):
+              self.update_bookmark(pos, dur)
+            event_resp("time", "T", "%s/%s" % (-1 if pos < 0 else sec2str(pos),
+                                               -1 if dur < 0 else sec2str(dur)))
+      elif self.is_stopped():
+        (_oldvalues[0], _oldvalues[1]) = (-1, -1)
+      return True
+    return _output
+    
+  def update_bookmark(self, pos, dur):
+    uri = self.origin_uri or self.engine.uri()
+    if not uri: return
+    if pos >= dur - BOOKMARK_END_MARGIN: self.bookmarks.remove(uri)
+    else: self.bookmarks.set(uri, pos)
+
+  def make_stall_watcher(self):
+    "Reconnect remote stream when position has not advanced while playing"
+    # [position, time of last advance, time of playing start]
+    _last = [-1, time.time(), None]
+    def _watch():
+      now = time.time()
+      # slow first connect is not a stall, it fails by itself
+      active = self.has_played and (self.reconnect_id is None) and \
+          (not self.paused) and \
+          (_PLAYING in self.requests or self.has_state("PLAYING", 0))
+      if not active:
+        (_last[0], _last[1], _last[2]) = (-1, now, None)
+        return True
+      pos = self.query_position(-1)
+      if pos != _last[0]:
+        if (_last[0] >= 0) and (pos > _last[0]):
+          if _last[2] is None: _last[2] = now
+          elif now - _last[2] >= RECONNECT_STABLE: self.backoff.reset()
+        (_last[0], _last[1]) = (pos, now)
+      elif now - _last[1] >= STALL_TIMEOUT:
+        uri = self.engine.uri()
+        (_last[0], _last[1], _last[2]) = (-1, now, None)
+        if self.auto_reconnect and uri and not is_localpath(uri):
+          wrn_resp("stream stalled - %s" % uri)
+          if not self.schedule_reconnect(uri, "stall"):
+            self.stop()
+            event_resp("state", "STOP")
+      return True
+    return _watch
+
+  def get_command(self):
+    "Get command from cmdqueue, and ignore repeated command"
+    def skip_with_addvalue(cmd, next_cmdlist):
+      nextcmd = next_cmdlist[0]
+      if cmd[0] == nextcmd[0]:
+        try:
+          newvalue = str( long(cmd[1]) + long(nextcmd[1]) )
+        except (IndexError, ValueError): return False
+        nextcmd[1] = newvalue # update! nextcmd[1]
+        return True
+      return False
+
+    with self.cmdqueue.lock:
+      cmdlist = self.cmdqueue.cmdlist
+      if _isdebug and cmdlist:  # for debug
+        print "CMDLIST=", self.cmdqueue.cmdlist # for debug
+      while cmdlist:
+        cmd = cmdlist.pop(0)
+        if not cmdlist: return cmd
+        elif cmd[0] in ("pause", "rec", "replay"):
+          if cmd[0] == cmdlist[0][0] :
+            if cmd[0] != "replay":
+              # skip this and next one
+              cmdlist.pop(0)
+          else: return cmd
+        elif cmd[0] == "skip":
+          if skip_with_addvalue(cmd, cmdlist):
+            continue
+          return cmd
+        elif cmd[0] == "jump" == cmdlist[0][0]:
+          continue # only the latest target matters
+        else: return cmd
+      return None
+
+  def dispatch_command(self):
+    try:
+      #cmdline = self.cmdqueue.get()
+      cmdline = self.get_command()
+      if cmdline:
+        _puts("dispatch_command cmdline=%s thread=%s", cmdline, threading.currentThread())
+        command = cmdline[0]
+        args = cmdline[1:]
+        cmdop = self.dispatch_table.get(command)
+        try:
+          if cmdop: cmdop(args)
+          else:
+            err_resp("Illegal command - %s" % command)
+        except Exception , exc:
+          self.requests.clear()
+          tblist = traceback.format_tb(sys.exc_info()[2])
+          if _isdebug:
+            for tbstr in tblist: sys.stdout.write(tbstr)
+            sys.stdout.flush()
+          err_resp("fail to dispatch_command: %s - %s" % (exc, cmdline))
+      else: time.sleep(0.01) # idle
+      return True
+    except BaseException, err: 
+      if not isinstance(err, KeyboardInterrupt):
+        if _isdebug:
+          tblist = traceback.format_tb(sys.exc_info()[2])
+          for tbstr in tblist: sys.stdout.write(tbstr)
+          sys.stdout.flush()
+      self.quit()
+
+  def response_by_state(self, ostate, nstate):
+    _puts("response_by_state req=%s", self.requests)
+    if nstate == "PLAYING":
+      if self.switch_start:
+        (started, mode) = self.switch_start
+        self.switch_latency = (int((time.time() - started) * 1000), mode)
+        self.switch_start = None
+        _puts("switch latency %dms (%s)", *self.switch_latency)
+      if _PLAYING in self.requests:
+        event_resp("state", "PLAY")
+        self.requests.discard(_PLAYING)
+      if _LOADING in self.requests:
+        uri = self.origin_uri or self.engine.uri()
+        event_resp("state", "LOAD", uri)
+        self.requests.discard(_LOADING)
+    elif nstate == "PAUSED":
+      if _PAUSING in self.requests:
+        event_resp("state", "PAUSE")
+        self.requests.discard(_PAUSING)
+    elif nstate == "NULL": # Not coming here
+      if _PAUSING in self.requests:
+        event_resp("state", "PAUSE")
+        self.requests.discard(_PAUSING)
+      if _STOPPING in self.requests:
+        event_resp("state", "STOP")
+        self.requests.discard(_STOPPING)
+
+
+  # Listener of the engine, called in the main thread
+
+  def on_eos(self):
+    uri = self.origin_uri or self.engine.uri()
+    self.engine.set_state("READY") # keep audio device for next
+    if uri: self.bookmarks.remove(uri)
+    event_resp("state", "STOP")
+    event_resp("state", "EOS", uri)
+
+  def on_tags(self, srctype, tags):
+    rgtags = dict()
+    for (k, v) in tags:
+      if (k in POSTPROC_TAGS) and isinstance(v, basestring):
+        self.stream_tags[k] = v
+      if k in ("replaygain-track-gain", "replaygain-track-peak"):
+        rgtags[k] = float(v)
+      if _events.allow("tags", k): resp("TAG", srctype, "%s=%s" % (k, v))
+    if rgtags: self.replaygain_tags(rgtags)
+
+  def on_state_changed(self, old, new, pending):
+    if new == "PLAYING": self.has_played = True
+    if (self.pending_seek is not None) and new in ("PAUSED", "PLAYING"):
+      # resume bookmarked position without waiting for preroll
+      (pos, self.pending_seek) = (self.pending_seek, None)
+      dur = self.query_duration(-1)
+      if (dur > pos) and self.engine.seek(pos):
+        resp("SEEK", "%s/%s" % (sec2str(nano2sec(pos)),
+                                sec2str(nano2sec(dur))))
+    if self.requests:
+      self.response_by_state(old, new)
+
+  def on_async_done(self):
+    if self.seeker.inflight is not None: self.seek_done()
+
+  def on_duration(self):
+    self.duration_cache = None
+
+  def on_buffering(self, percent):
+    if _events.wants("buffering"):
+      event_resp("buffering", "BUFFERING", percent)
+
+  def on_warning(self, err, debug):
+    if _isdebug: wrn_resp("%s - %s" % (err, debug))
+    else: wrn_resp(err)
+
+  def on_error(self, err, debug, network):
+    "network -- err is a transient read/connect failure of remote uri"
+    if self.reconnect_id is not None:
+      _puts("Ignore error while reconnecting - %s", err)
+      return
+    uri = self.engine.uri()
+    if self.origin_uri and (self.origin_uri != uri):
+      # cached redirect target may be stale, retry requested uri at once
+      # (pending LOAD is kept), ERROR only if it fails too
+      wrn_resp("%s - retry %s" % (err, self.origin_uri))
+      self.resolver.invalidate(self.origin_uri)
+      self.requests.add(_PLAYING)
+      self.play(self.origin_uri)
+      return
+    # first open fails fast (e.g. dead station in playlist)
+    if self.auto_reconnect and self.has_played and network:
+      wrn_resp(err)
+      if self.schedule_reconnect(uri, "error"): return
+    self.engine.set_state("NULL")
+    if _isdebug: err_resp("%s - %s" % (err, debug))
+    else: err_resp(err)
+    self.stop()
+    event_resp("state", "STOP")
+
+if sys.version_info[0] >= 2 and sys.version_info[1] >= 6:
+  _urlopen = urllib2.urlopen
+  _opener_open = lambda opener, req, timeout: opener.open(req, None, timeout)
+else:
+  # when python 2.5 , ignore timeout argument
+  _urlopen = lambda *args,**kwd: urllib2.urlopen(*args[:2])
+  _opener_open = lambda opener, req, timeout: opener.open(req)
+
+# raise urllib2.URLError < IOError
+def get_playlist(path, http_force=False, timeout=30):
+  r'''Read pls or m3u playlist , return following dictionary 
+  {"_type":"m3u|pls", 
+   "_entries":{["file":file-name, "length":duration, "title":title]...},
+   "numberofentries":Number-Of-Entries }'''
+  path = path.strip()
+  filetype = None
+  m = re.match(r'''(http|https|ftp)://''', path, re.I)
+  if m:
+    proto = m.group(1).lower()
+    f = None
+    try:
+      # f = urllib2.urlopen(path, timeout=timeout) 
+      f = _urlopen(path, timeout=timeout) 
+      ctype = f.info().getheader("content-type","").lower().split(";")
+      if ctype[0] == "audio/x-scpls": filetype = "pls"
+      elif ctype[0] == "audio/x-mpegurl": filetype = "m3u"
+      if filetype or http_force or proto == "ftp":
+        return read_playlist(f, filetype, path)
+      else:
+        return None
+    finally:
+      if f: f.close()
+  else:
+    path = os.path.abspath( os.path.expanduser(path) )
+    (_, ext) = os.path.splitext(path)
+    ext = ext.lower()
+    if ext == ".pls": filetype = "pls"
+    elif ext == ".m3u": filetype = "m3u"
+    with open(path, "r") as f:
+      return read_playlist(f, filetype, path)
+
+def read_playlist(f, filetype, path):
+  line = "\n"
+  if not filetype:
+    # read first line
+    while line and line.strip() == "": line = f.readline(8192)
+    if not line: return(dict())
+    if line.strip() == "": return(dict())
+    if line.strip().lower() == "[playlist]":
+      filetype = "pls"
+    else:
+      filetype = "m3u" # ??
+  
+  if filetype == "pls": return read_pls(f)
+  else: return read_m3u(f, line)
+    
+def read_pls(f, unread=None):
+  r'''Read pls, return following dictionary 
+  {"_type": "pls",
+   "_entries": [{"file":file-name, "length":duration, "title":title}...],
+   "numberofentries": Number-Of-Entries, 
+   "version": versin-number-string }'''
+
+  rchop = re.compile( r'[\n\r]+\Z' )
+  ritem = re.compile( r'''(file|title|length)(\d+)''' )
+  plsinfo = dict()
+  entries = dict()
+  def parse(line):
+    # binary check??
+    if (len(line) > 1024) and ("\x00" in line): raise ValueError
+    if line.strip() == "": return
+    datas = rchop.sub("", line).split("=")
+    if len(datas) <= 1: return
+    key=datas[0].lower().strip()
+    m = ritem.match(key)
+    if m:
+      vkey = m.group(1)
+      nkey = int(m.group(2))
+      val = entries.get(nkey, dict())
+      data = "=".join(datas[1:])
+      try:
+        if vkey == "length": 
+          data = long(data)
+        val[vkey] = data
+        entries[nkey] = val
+      except:pass
+    elif key == "numberofentries":
+      try:  plsinfo[key] = int(datas[1])
+      except ValueError:pass
+    else:
+      plsinfo[key] = "=".join(datas[1:])
+  
+  try:
+    if unread: parse(unread)
+    for line in f: parse(line)
+  
+    plsinfo["_entries"] = [entries[k] for k in sorted(entries.keys())]
+    plsinfo["_type"] = "pls"
+    return plsinfo
+
+  except ValueError:
+    _puts("Not pls file - read_m3u")
+    return dict()
+
+def read_m3u(f, unread=None):
+  r'''Read m3u, return following dictionary 
+  {"_type": "m3u",
+   "_entries":[{"file":file-name, "length":duration, "title":title}...],
+   "numberofentries":Number-Of-Entries }'''
+  rchop = re.compile( r'[\n\r]+\Z' )
+  entries = list()
+  extinf = dict()
+  def parse(line):
+    # binary check??
+    if (len(line) > 1024) and ("\x00" in line): raise ValueError
+    if line.strip() == "": return
+    line = rchop.sub("", line)
+    if line[0] == "#":
+      m = re.match("#extinf:", line, re.I)
+      if m:
+        datas = line[m.end():].split(",", 1)
+        try:
+          extinf["length"] = long(datas[0])
+        except:pass
+        if len(datas) > 1: extinf["title"] = datas[1]
+    else:
+      extinf["file"] = line
+      entries.append(dict(extinf))
+      extinf.clear()
+
+  try:
+    if unread: parse(unread)
+    for line in f: parse(line)
+    return {"_type":"m3u", "_entries":entries, "numberofentries":len(entries)}
+  except ValueError:
+    _puts("Not m3u file - read_m3u")
+    return dict()
+
+
+# getopt long options of both engine scripts,
+# --engine is handled by exec_engine and --sink* by sink_args
+PLAYER_OPTIONS = ["sink=", "sink-device=", "sink-profile=", "buffer-time=",
+                  "latency-time=", "engine=", "normalize", "prefetch=",
+                  "retention=", "postproc=", "postproc-job=", "tag="]
+
+def player_options(opts):
+  "dict of normalize, prefetch, retention, postproc, job and tags by opts"
+  conf = {"normalize":False, "prefetch":PREFETCH_BUDGET, "retention":None,
+          "postproc":None, "job":None, "tags":dict()}
+  for (opt, value) in opts:
+    if opt == "--normalize": conf["normalize"] = True
+    elif opt == "--prefetch": conf["prefetch"] = max(0, int(value))
+    elif opt == "--retention": # DAYS[:MBYTES]
+      (days, _, mbytes) = value.partition(":")
+      conf["retention"] = (max(0.0, float(days)),
+                           max(0, int(mbytes or 0)) * 1024 * 1024)
+    elif opt == "--postproc": # FMT[,trim][,remove]
+      conf["postproc"] = parse_postproc_mode(value.split(","))
+    elif opt == "--postproc-job": # run by PostProcessor
+      conf["job"] = parse_postproc_mode(value.split(","))
+    elif opt == "--tag": # KEY=VALUE of --postproc-job
+      (key, _, tagval) = value.partition("=")
+      conf["tags"][key] = tagval
+  return conf
+
+def run_postproc_job(program, args, conf, gst_launch):
+  "`--postproc-job=FMT[,trim][,remove] PATH', returns exit status"
+  if len(args) != 1 or not conf["job"][0]:
+    err_resp("%s - usage: --postproc-job=FMT[,trim][,remove] PATH" % program)
+    return 2
+  return postproc_job(args[0], conf["tags"], gst_launch, *conf["job"])